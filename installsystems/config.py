@@ -213,6 +213,8 @@ repo_filter = string
 repo_timeout = integer
 cache = string(default=%s)
 timeout = integer
+jobs = integer(1)
+compressor_threads = integer(0)
 no_cache = boolean
 no_check = boolean
 no-sync = boolean
@@ -234,4 +236,5 @@ REPO_CONFIG_SPEC = '''\
     offline = boolean
     lastpath = string
     dbpath = string
+    catalogpath = string
 '''
@@ -25,3 +25,4 @@ from installsystems.image.source import SourceImage
 from installsystems.image.package import PackageImage
 from installsystems.image.payload import Payload
 from installsystems.image.changelog import Changelog
+from installsystems.image.cache import MetadataCache, BytecodeCache
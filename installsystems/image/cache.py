@@ -0,0 +1,172 @@
+# -*- python -*-
+# -*- coding: utf-8 -*-
+
+# This file is part of Installsystems.
+#
+# Installsystems is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Installsystems is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Installsystems.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Image metadata cache module
+'''
+
+from hashlib import md5, sha1
+from installsystems.exception import ISError
+from installsystems.printer import debug
+from json import dumps, loads
+from os import getpid, mkdir, rename, unlink
+from os.path import join, exists
+from threading import Lock
+from time import time
+import sqlite3
+
+class MetadataCache(object):
+    '''
+    Persistent cache of image metadata members, indexed by image md5
+    Images are immutable, so cached entries never need to be refreshed.
+    Each entry is checked against its own md5 when read, and least recently
+    used entries are evicted when the cache grows above max_size bytes.
+    The cache can be shared by threads loading images.
+    '''
+
+    def __init__(self, path, max_size=16 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.lock = Lock()
+        try:
+            self.conn = sqlite3.connect(path, isolation_level=None, timeout=10,
+                                        check_same_thread=False)
+            self.conn.executescript(TEMPLATE_METADATA_DB)
+        except Exception as e:
+            raise ISError(u"Unable to open metadata cache %s" % path, e)
+
+    def close(self):
+        '''
+        Close the cache database
+        '''
+        self.conn.close()
+
+    def get(self, image_md5):
+        '''
+        Return the dict of metadata members of an image, or None if not cached
+        '''
+        with self.lock:
+            return self._get(image_md5)
+
+    def _get(self, image_md5):
+        try:
+            r = self.conn.execute("SELECT data, checksum FROM metadata WHERE md5 = ?",
+                                  (image_md5,)).fetchone()
+            if r is None:
+                return None
+            data = str(r[0])
+            if md5(data).hexdigest() != r[1]:
+                debug(u"Corrupted metadata cache entry %s" % image_md5)
+                self.conn.execute("DELETE FROM metadata WHERE md5 = ?", (image_md5,))
+                return None
+            self.conn.execute("UPDATE metadata SET atime = ? WHERE md5 = ?",
+                              (int(time()), image_md5))
+            return dict((k, v.encode("UTF-8")) for k, v in loads(data).items())
+        except Exception as e:
+            debug(u"Unable to read metadata cache: %s" % e)
+            return None
+
+    def set(self, image_md5, members):
+        '''
+        Store the dict of metadata members of an image
+        members content must be UTF-8 encoded strings
+        '''
+        with self.lock:
+            self._set(image_md5, members)
+
+    def _set(self, image_md5, members):
+        try:
+            data = dumps(members)
+            self.conn.execute("INSERT OR REPLACE INTO metadata "
+                              "(md5, data, checksum, size, atime) VALUES (?,?,?,?,?)",
+                              (image_md5, buffer(data), md5(data).hexdigest(),
+                               len(data), int(time())))
+            self.evict()
+        except Exception as e:
+            debug(u"Unable to write metadata cache: %s" % e)
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the cache fits in max_size
+        '''
+        total = self.conn.execute("SELECT TOTAL(size) FROM metadata").fetchone()[0]
+        if total <= self.max_size:
+            return
+        evicted = []
+        for image_md5, size in self.conn.execute(
+            "SELECT md5, size FROM metadata ORDER BY atime").fetchall():
+            if total <= self.max_size:
+                break
+            evicted.append((image_md5,))
+            total -= size
+        self.conn.executemany("DELETE FROM metadata WHERE md5 = ?", evicted)
+        debug(u"%d metadata cache entries evicted" % len(evicted))
+
+
+class BytecodeCache(object):
+    '''
+    Persistent cache of marshaled scripts bytecode, a file by bytecode key
+    Each file starts with the sha1 digest of its content, checked when read.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            if not exists(path):
+                mkdir(path)
+        except Exception as e:
+            raise ISError(u"Unable to create bytecode cache %s" % path, e)
+
+    def get(self, key):
+        '''
+        Return marshaled bytecode from its key, or None if not cached
+        '''
+        try:
+            with open(join(self.path, key), "rb") as fo:
+                data = fo.read()
+        except IOError:
+            return None
+        if sha1(data[20:]).digest() != data[:20]:
+            debug(u"Corrupted bytecode cache entry %s" % key)
+            return None
+        return data[20:]
+
+    def set(self, key, data):
+        '''
+        Store marshaled bytecode with its key
+        '''
+        path = join(self.path, key)
+        tmppath = u"%s.%d.tmp" % (path, getpid())
+        try:
+            with open(tmppath, "wb") as fo:
+                fo.write(sha1(data).digest())
+                fo.write(data)
+            rename(tmppath, path)
+        except Exception as e:
+            debug(u"Unable to write bytecode cache: %s" % e)
+            if exists(tmppath):
+                unlink(tmppath)
+
+
+TEMPLATE_METADATA_DB = u"""
+CREATE TABLE IF NOT EXISTS metadata (md5 TEXT NOT NULL PRIMARY KEY,
+                                     data BLOB NOT NULL,
+                                     checksum TEXT NOT NULL,
+                                     size INTEGER NOT NULL,
+                                     atime INTEGER NOT NULL);
+"""
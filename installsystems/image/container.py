@@ -0,0 +1,185 @@
+# -*- python -*-
+# -*- coding: utf-8 -*-
+
+# This file is part of Installsystems.
+#
+# Installsystems is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Installsystems is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Installsystems.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Image container module
+
+Since format 3, a packaged image is a container made of:
+ - a magic string and the header length (4 bytes, big endian)
+ - an uncompressed JSON header with format, description, changelog and
+   the list of sections (name, compressor, offset and size)
+ - sections, each one being an independently compressed tarball of a
+   script directory (setup, build, parser, lib)
+
+Sections offsets are relative to the end of the header, so the metadata of
+an image can be read from its first bytes only.
+
+Older installsystems are not able to read containers, so the minimum
+installsystems version of their description is raised to MIN_VERSION.
+'''
+
+from cStringIO import StringIO
+from installsystems.exception import ISError
+from installsystems.image.tarball import Tarball
+from installsystems.printer import warn
+from installsystems.tools import get_compressor_path, compare_versions
+from json import loads, dumps
+from struct import Struct
+from subprocess import Popen, PIPE
+from tarfile import REGTYPE
+
+# magic string of image containers
+MAGIC = "ISIMAGE\x03"
+
+# magic string and header length
+PREFIX = Struct(">8sI")
+
+# size of image head read to get metadata
+HEAD_SIZE = 65536
+
+# minimum installsystems version able to read a container
+MIN_VERSION = "10"
+
+# section compressors, by order of preference
+# gzip comes first because it is the only one required on install hosts
+COMPRESSORS = ("gzip", "xz")
+
+
+def is_container(head):
+    '''
+    Return True if head is the beginning of an image container
+    '''
+    return head.startswith(MAGIC)
+
+def header_size(head):
+    '''
+    Return the size of prefix and header of a container from its head
+    '''
+    if len(head) < PREFIX.size or not is_container(head):
+        raise ISError("Invalid image container")
+    return PREFIX.size + PREFIX.unpack(head[:PREFIX.size])[1]
+
+def read_header(head):
+    '''
+    Return the header dict of a container from its head
+    head must be at least header_size(head) long
+    '''
+    size = header_size(head)
+    if len(head) < size:
+        raise ISError("Truncated image container header")
+    try:
+        return loads(head[PREFIX.size:size])
+    except Exception as e:
+        raise ISError("Invalid image container header", e)
+
+def header_members(header):
+    '''
+    Return a dict of metadata members content from a container header
+    Content is encoded as in a tarball based image
+    '''
+    members = {"format": header["format"].encode("UTF-8"),
+               "description.json": dumps(header["description"])}
+    if header.get("changelog") is not None:
+        members["changelog"] = header["changelog"].encode("UTF-8")
+    return members
+
+def _pipe(argv, data):
+    '''
+    Return data processed by an external (de)compressor
+    '''
+    try:
+        p = Popen(argv, stdin=PIPE, stdout=PIPE, close_fds=True)
+        out = p.communicate(data)[0]
+    except Exception as e:
+        raise ISError(u"Unable to run %s" % argv[0], e)
+    if p.returncode != 0:
+        raise ISError(u"%s return %d" % (argv[0], p.returncode))
+    return out
+
+def section_compressor():
+    '''
+    Return the name of the preferred available section compressor
+    '''
+    for name in COMPRESSORS:
+        try:
+            get_compressor_path(name)
+            return name
+        except ISError:
+            continue
+    raise ISError("No section compressor available")
+
+def write_container(fileobj, img_format, description, changelog, sections,
+                    compressor=None):
+    '''
+    Write an image container into fileobj
+    description is the JSON description string, changelog the verbatim
+    changelog (or None) and sections a list of (name, tarball content)
+    '''
+    if compressor is None:
+        compressor = section_compressor()
+    argv = get_compressor_path(compressor)
+    description = loads(description)
+    if compare_versions(description.get("is_min_version", 0), MIN_VERSION) < 0:
+        warn(u"Minimum Installsystems version raised to %s by image format %s"
+             % (MIN_VERSION, img_format))
+        description["is_min_version"] = MIN_VERSION
+    header = {"format": img_format,
+              "description": description,
+              "changelog": changelog,
+              "sections": []}
+    datas = []
+    offset = 0
+    for name, content in sections:
+        data = _pipe(argv, content)
+        header["sections"].append({"name": name,
+                                   "compressor": compressor,
+                                   "offset": offset,
+                                   "size": len(data)})
+        datas.append(data)
+        offset += len(data)
+    jheader = dumps(header)
+    fileobj.write(PREFIX.pack(MAGIC, len(jheader)))
+    fileobj.write(jheader)
+    for data in datas:
+        fileobj.write(data)
+
+def unpack_container(fileobj, tarfileobj):
+    '''
+    Write into tarfileobj a plain tarball with metadata and sections content
+    of the container in fileobj
+    '''
+    head = fileobj.read(PREFIX.size)
+    head += fileobj.read(header_size(head) - PREFIX.size)
+    header = read_header(head)
+    members = header_members(header)
+    mtime = header["description"].get("date")
+    tarball = Tarball.open(fileobj=tarfileobj, mode="w:")
+    for name in ("description.json", "changelog", "format"):
+        if name in members:
+            tarball.add_str(name, members[name], REGTYPE, 0644, mtime)
+    for section in sorted(header["sections"], key=lambda x: x["offset"]):
+        fileobj.seek(len(head) + section["offset"])
+        data = fileobj.read(section["size"])
+        if len(data) != section["size"]:
+            raise ISError(u"Truncated image section %s" % section["name"])
+        argv = get_compressor_path(section["compressor"], compress=False)
+        stball = Tarball.open(fileobj=StringIO(_pipe(argv, data)), mode="r:")
+        for ti in stball.getmembers():
+            tarball.addfile(ti, stball.extractfile(ti) if ti.isfile() else None)
+        stball.close()
+    tarball.close()
@@ -21,15 +21,38 @@
 Image abstract module
 '''
 
-from imp import new_module
+from contextlib import contextmanager
+from distutils.sysconfig import get_python_lib
+from hashlib import sha1
+from imp import new_module, get_magic
 from installsystems import VERSION
 from installsystems.exception import ISError
-from installsystems.printer import arrow, arrowlevel
+from installsystems.printer import arrow, arrowlevel, debug
+from installsystems.profiler import span
 from installsystems.tools import compare_versions
 from locale import getpreferredencoding
-from os import getcwd, chdir
-from os.path import splitext
+from os import getcwd, chdir, sep
+from os.path import splitext, abspath
 from re import match, split
+import marshal
+import sys
+
+# standard library directory
+STDLIB_PATH = get_python_lib(standard_lib=True)
+
+def is_stdlib_module(name, module):
+    '''
+    Return True if module is a module of the python standard library
+    '''
+    if module is None or name == "__main__" or name.startswith("installsystems"):
+        return False
+    path = getattr(module, "__file__", None)
+    if path is None:
+        return name in sys.builtin_module_names
+    path = abspath(path)
+    return (path.startswith(STDLIB_PATH + sep)
+            and "-packages" + sep not in path[len(STDLIB_PATH):])
+
 
 class Image(object):
     '''
@@ -39,8 +62,52 @@ class Image(object):
     extension = ".isimage"
     default_compressor = "gzip"
 
+    # minimum installsystems version able to extract payloads, by compressor
+    compressors_min_version = {"zstd": "10", "lz4": "10"}
+
+    # persistent bytecode cache (installsystems.image.cache.BytecodeCache)
+    bytecode_cache = None
+
     def __init__(self):
         self.modules = {}
+        # standard library modules imported by scripts, shared by the phases
+        # of this image only
+        self.stdlib_modules = {}
+        self._isolated = False
+
+    @staticmethod
+    def bytecode_key(code, filename):
+        '''
+        Return the bytecode key of code compiled with filename by the running
+        python interpreter
+        '''
+        return sha1("%s\0%s\0%s" % (get_magic(), filename, code)).hexdigest()
+
+    def embedded_bytecode(self, key):
+        '''
+        Return marshaled bytecode stored inside the image or None
+        '''
+        return None
+
+    def compile_script(self, code, filename):
+        '''
+        Return bytecode of a script, as compile builtin does
+        Bytecode is loaded from the image or the bytecode cache when possible
+        filename is the encoded name given to compile, used in tracebacks
+        '''
+        key = self.bytecode_key(code, filename)
+        data = self.embedded_bytecode(key)
+        if data is None and self.bytecode_cache is not None:
+            data = self.bytecode_cache.get(key)
+        if data is not None:
+            try:
+                return marshal.loads(data)
+            except Exception as e:
+                debug(u"Invalid bytecode of %s: %s" % (filename, e))
+        bytecode = compile(code, filename, "exec")
+        if self.bytecode_cache is not None:
+            self.bytecode_cache.set(key, marshal.dumps(bytecode))
+        return bytecode
 
     def _load_module(self, name, filename, code=None):
         '''
@@ -57,7 +124,7 @@ class Image(object):
         module = new_module(name)
         # compile module code
         try:
-            bytecode = compile(code, filename.encode(getpreferredencoding()), "exec")
+            bytecode = self.compile_script(code, filename.encode(getpreferredencoding()))
         except Exception as e:
             raise ISError(u"Unable to compile %s" % filename, e)
         # load module
@@ -79,14 +146,18 @@ class Image(object):
         arrow(u"Load lib scripts")
         old_level = arrowlevel(1)
         self.modules = {}
-        for fp, fn, fc in select_scripts():
-            # check input unicode stuff
-            assert(isinstance(fp, unicode))
-            assert(isinstance(fn, unicode))
-            assert(isinstance(fc, str))
-            arrow(fn)
-            module_name = splitext(fn.split('-', 1)[1])[0]
-            self.modules[module_name] = self._load_module(module_name, fp, fc)
+        with span("lib"):
+            scripts = list(select_scripts())
+            with self.isolated_modules():
+                for fp, fn, fc in scripts:
+                    # check input unicode stuff
+                    assert(isinstance(fp, unicode))
+                    assert(isinstance(fn, unicode))
+                    assert(isinstance(fc, str))
+                    arrow(fn)
+                    module_name = splitext(fn.split('-', 1)[1])[0]
+                    with span(fn):
+                        self.modules[module_name] = self._load_module(module_name, fp, fc)
         arrowlevel(level=old_level)
 
     def run_scripts(self, scripts_name, select_scripts, exec_directory, global_dict):
@@ -107,50 +178,80 @@ class Image(object):
         arrow(u"Run %s scripts" % scripts_name)
         # backup current directory and loaded modules
         cwd = getcwd()
-        for fp, fn, fc in select_scripts():
-            # check input unicode stuff
-            assert(isinstance(fp, unicode))
-            assert(isinstance(fn, unicode))
-            assert(isinstance(fc, str))
-            arrow(fn, 1)
-            # backup arrow level
-            old_level = arrowlevel(2)
-            # chdir in exec_directory
-            chdir(exec_directory)
-            # compile source code
-            try:
-                bytecode = compile(fc, fn.encode(getpreferredencoding()), "exec")
-            except Exception as e:
-                raise ISError(u"Unable to compile script %s" % fp, e)
-            # add current image
-            global_dict["image"] = self
-            # execute source code
-            self.secure_exec_bytecode(bytecode, fp, global_dict)
-            arrowlevel(level=old_level)
+        with span(scripts_name):
+            scripts = list(select_scripts())
+            with self.isolated_modules():
+                for fp, fn, fc in scripts:
+                    # check input unicode stuff
+                    assert(isinstance(fp, unicode))
+                    assert(isinstance(fn, unicode))
+                    assert(isinstance(fc, str))
+                    arrow(fn, 1)
+                    # backup arrow level
+                    old_level = arrowlevel(2)
+                    # chdir in exec_directory
+                    chdir(exec_directory)
+                    with span(fn):
+                        # compile source code
+                        try:
+                            bytecode = self.compile_script(fc, fn.encode(getpreferredencoding()))
+                        except Exception as e:
+                            raise ISError(u"Unable to compile script %s" % fp, e)
+                        # add current image
+                        global_dict["image"] = self
+                        # execute source code
+                        self.secure_exec_bytecode(bytecode, fp, global_dict)
+                    arrowlevel(level=old_level)
         chdir(cwd)
 
-    def secure_exec_bytecode(self, bytecode, path, global_dict):
+    @contextmanager
+    def isolated_modules(self):
         '''
-        Execute bytecode in a clean modules' environment, without altering
-        Installsystems' sys.modules
+        Run a phase of scripts in a clean modules' environment
+        Installsystems' sys.modules is saved once for the whole phase and
+        restored after it. Standard library modules imported by scripts are
+        kept for next phases of the image, so they are not imported again by
+        each script.
         '''
-        import sys
         import installsystems.printer
 
         # system modules dict
         sysmodules = sys.modules
         sysmodules_backup = sysmodules.copy()
+        # replace system modules by image loaded
+        # we must use the same directory and not copy it (probably C reference)
+        sysmodules.clear()
+        # sys must be in sys.module to allow loading of modules
+        sysmodules["sys"] = sys
+        sysmodules.update(self.stdlib_modules)
+        sysmodules.update(self.modules)
+        # we need installsystems.printer to conserve arrow level
+        sysmodules["installsystems.printer"] = installsystems.printer
+        self._isolated = True
+        try:
+            yield
+        finally:
+            self._isolated = False
+            for name, module in sysmodules.items():
+                if name not in self.modules and is_stdlib_module(name, module):
+                    self.stdlib_modules[name] = module
+            sysmodules.clear()
+            sysmodules.update(sysmodules_backup)
+
+    def secure_exec_bytecode(self, bytecode, path, global_dict):
+        '''
+        Execute bytecode in a clean modules' environment, without altering
+        Installsystems' sys.modules
+        Outside of a phase (see isolated_modules), the environment is created
+        for this bytecode only
+        '''
+        if not self._isolated:
+            with self.isolated_modules():
+                return self.secure_exec_bytecode(bytecode, path, global_dict)
         # autoload modules
         global_dict.update(self.modules)
+        sys.modules.update(self.modules)
         try:
-            # replace system modules by image loaded
-            # we must use the same directory and not copy it (probably C reference)
-            sysmodules.clear()
-            # sys must be in sys.module to allow loading of modules
-            sysmodules["sys"] = sys
-            sysmodules.update(self.modules)
-            # we need installsystems.printer to conserve arrow level
-            sysmodules["installsystems.printer"] = installsystems.printer
             exec bytecode in global_dict
         except SystemExit as e:
             # skip a script which call exit(0) or exit()
@@ -160,9 +261,6 @@ class Image(object):
                 raise ISError(u"Script %s exits with status" % path, e)
         except Exception as e:
             raise ISError(u"Fail to execute script %s" % path, e)
-        finally:
-            sysmodules.clear()
-            sysmodules.update(sysmodules_backup)
 
     @staticmethod
     def check_name(buf):
@@ -25,17 +25,24 @@ from difflib import unified_diff
 from installsystems import VERSION
 from installsystems.exception import ISError
 from installsystems.image.changelog import Changelog
+from installsystems.image.container import HEAD_SIZE, is_container, header_size
+from installsystems.image.container import read_header, header_members
+from installsystems.image.container import unpack_container, write_container
 from installsystems.image.image import Image
-from installsystems.image.payload import Payload
+from installsystems.image.payload import Payload, PayloadsExtraction
 from installsystems.image.source import SourceImage, DESCRIPTION_TPL
 from installsystems.image.tarball import Tarball
 from installsystems.printer import warn, arrow, arrowlevel, out, debug
+from installsystems.profiler import span, bind
 from installsystems.tools import mkdir, abspath, time_rfc2822, human_size, argv, PipeFile
+from installsystems.tools import parallel_imap
 from json import loads, dumps
 from math import floor
-from os import listdir
-from os.path import join, basename, exists, isdir, dirname, abspath
+from os import listdir, rename, unlink
+from os.path import join, basename, exists, isdir, dirname
+from tempfile import SpooledTemporaryFile
 from time import time
+from zlib import decompressobj, MAX_WBITS
 
 class PackageImage(Image):
     '''
@@ -84,44 +91,83 @@ class PackageImage(Image):
                 else:
                    out(line, endl="")
 
-    def __init__(self, path, fileobj=None, md5name=False):
+    # members holding image metadata, stored at the head of the tarball
+    metadata_members = ("description.json", "changelog", "format")
+
+    # metadata of already opened images, indexed by image md5
+    metadata_cache = {}
+
+    # persistent metadata cache (installsystems.image.cache.MetadataCache)
+    cache = None
+
+    # uncompressed images bigger than this are buffered in a temporary file
+    # instead of memory
+    spool_size = 64 * 1024 * 1024 # 64MiB
+
+    def __init__(self, path, fileobj=None, md5name=False, objpath=None,
+                 md5=None, size=None):
         '''
         Initialize a package image
 
         fileobj must be a seekable fileobj
+        objpath is a function returning the path of a payload from its md5,
+        when tarballs are named by md5 (default: in the image directory)
+        md5 and size are the known values of the image (e.g from a repository).
+        When both are set, the image is opened in metadata only mode: only the
+        metadata members are read and the whole tarball is loaded when needed.
         '''
         Image.__init__(self)
         self.path = abspath(path)
         self.base_path = dirname(self.path)
         # tarball are named by md5 and not by real name
         self.md5name = md5name
-        try:
-            if fileobj is None:
-                fileobj = PipeFile(self.path, "r")
+        self.md5 = md5
+        self.size = size
+        self._tarfile = None
+        # metadata are stored in the persistent cache
+        self._cached = False
+        # payloads extracted in background
+        self._extractions = []
+        if md5 is not None and size is not None and fileobj is None:
+            if md5 in self.metadata_cache:
+                debug(u"Using cached metadata of image %s" % md5)
+                self._metadata = self.metadata_cache[md5]
             else:
-                fileobj = PipeFile(mode="r", fileobj=fileobj)
-            memfile = StringIO()
-            fileobj.consume(memfile)
-            # close source
-            fileobj.close()
-            # get downloaded size and md5
-            self.size = fileobj.read_size
-            self.md5 = fileobj.md5
-            memfile.seek(0)
-            self._tarball = Tarball.open(fileobj=memfile, mode='r:gz')
-        except Exception as e:
-            raise ISError(u"Unable to open image %s" % path, e)
-        self._metadata = self.read_metadata()
+                members = None
+                if self.cache is not None:
+                    members = self.cache.get(md5)
+                if members is not None:
+                    debug(u"Using persistent cached metadata of image %s" % md5)
+                    self._metadata = self.read_metadata(members)
+                    self._cached = True
+                else:
+                    # head is not verified, metadata are persistently cached
+                    # only when the whole image is loaded
+                    members = self._read_head()
+                    self._metadata = self.read_metadata(members)
+        else:
+            self._load(fileobj)
+            self._metadata = self.read_metadata()
+        self.metadata_cache[self.md5] = self._metadata
         # print info
         arrow(u"Image %s v%s loaded" % (self.name, self.version))
         arrow(u"Author: %s" % self.author, 1)
         arrow(u"Date: %s" % time_rfc2822(self.date), 1)
         # build payloads info
+        self._objpath = objpath
+        self.load_payloads()
+
+    def load_payloads(self):
+        '''
+        Build payloads info from metadata
+        '''
         self.payload = {}
         for pname, pval in self._metadata["payload"].items():
             pfilename = u"%s-%s%s" % (self.filename[:-len(Image.extension)],
                                       pname, Payload.extension)
-            if self.md5name:
+            if self.md5name and self._objpath is not None:
+                ppath = self._objpath(self._metadata["payload"][pname]["md5"])
+            elif self.md5name:
                 ppath = join(self.base_path,
                                      self._metadata["payload"][pname]["md5"])
             else:
@@ -136,6 +182,130 @@ class PackageImage(Image):
             return self._metadata[name]
         raise AttributeError
 
+    @property
+    def _tarball(self):
+        '''
+        Return image tarball, loading the whole image on first access
+        '''
+        if self._tarfile is None:
+            self._load()
+        return self._tarfile
+
+    def _load(self, fileobj=None):
+        '''
+        Load the whole image tarball and check its md5 and size
+        Image is hashed and decompressed in a single pass into a seekable
+        buffer, big images are spooled to a temporary file. Members are read
+        from the uncompressed tarball, so reading a member never needs to
+        decompress the image from its start. Sections of image containers
+        are unpacked into the same plain tarball.
+        '''
+        with span(u"image %s" % self.path):
+            self._load_tarball(fileobj)
+        # metadata read before in metadata only mode are not verified, they
+        # are replaced by the ones of the verified tarball
+        if "_metadata" in self.__dict__:
+            self._metadata = self.read_metadata()
+            self.metadata_cache[self.md5] = self._metadata
+            self.load_payloads()
+        # md5 and size are verified, metadata can be persistently cached
+        self.cache_metadata()
+
+    def _load_tarball(self, fileobj):
+        try:
+            if fileobj is None:
+                fileobj = PipeFile(self.path, "r")
+            else:
+                fileobj = PipeFile(mode="r", fileobj=fileobj)
+            memfile = SpooledTemporaryFile(max_size=self.spool_size)
+            buf = fileobj.read(1048576) # 1MiB
+            if is_container(buf):
+                rawfile = SpooledTemporaryFile(max_size=self.spool_size)
+                while len(buf) > 0:
+                    rawfile.write(buf)
+                    buf = fileobj.read(1048576)
+                rawfile.seek(0)
+                unpack_container(rawfile, memfile)
+                rawfile.close()
+            else:
+                # gzip decompression, handling concatenated gzip members
+                gunzip = decompressobj(16 + MAX_WBITS)
+                while len(buf) > 0:
+                    data = buf
+                    while len(data) > 0:
+                        memfile.write(gunzip.decompress(data))
+                        data = gunzip.unused_data
+                        if len(data) > 0:
+                            gunzip = decompressobj(16 + MAX_WBITS)
+                    buf = fileobj.read(1048576)
+                memfile.write(gunzip.flush())
+            # close source
+            fileobj.close()
+            memfile.seek(0)
+            tarball = Tarball.open(fileobj=memfile, mode='r:')
+        except Exception as e:
+            raise ISError(u"Unable to open image %s" % self.path, e)
+        # check downloaded size and md5 against known ones
+        if self.md5 is not None and self.md5 != fileobj.md5:
+            raise ISError(u"Image MD5 verification failure")
+        if self.size is not None and self.size != fileobj.read_size:
+            raise ISError(u"Image size verification failure")
+        self.md5 = fileobj.md5
+        self.size = fileobj.read_size
+        self._tarfile = tarball
+
+    def _read_head(self):
+        '''
+        Return a dict of metadata members content, from the head of the image
+        Only the first HEAD_SIZE bytes are fetched (a single http range request).
+        Image containers store metadata in their uncompressed header. With gzip
+        tarballs, the whole image is streamed when its head is not enough.
+        '''
+        try:
+            fileobj = PipeFile(self.path, "r", head=HEAD_SIZE)
+            try:
+                head = fileobj.read()
+            finally:
+                fileobj.close()
+            if is_container(head):
+                # header bigger than head
+                if len(head) < header_size(head):
+                    fileobj = PipeFile(self.path, "r", head=header_size(head))
+                    try:
+                        head = fileobj.read()
+                    finally:
+                        fileobj.close()
+                return header_members(read_header(head))
+            try:
+                return self._read_tar_head(StringIO(head))
+            except Exception as e:
+                debug(u"Image head is not enough: %s" % e)
+            fileobj = PipeFile(self.path, "r")
+            try:
+                return self._read_tar_head(fileobj)
+            finally:
+                fileobj.close()
+        except Exception as e:
+            raise ISError(u"Unable to open image %s" % self.path, e)
+
+    def _read_tar_head(self, fileobj):
+        '''
+        Return a dict of metadata members content from a gzip tarball stream
+        Decompression stops at the first non metadata member
+        '''
+        members = {}
+        tarball = Tarball.open(fileobj=fileobj, mode="r|gz")
+        for ti in tarball:
+            if ti.name not in self.metadata_members:
+                # older images may not store metadata first
+                if "format" in members and "description.json" in members:
+                    break
+                continue
+            members[ti.name] = tarball.extractfile(ti).read()
+        if "format" not in members or "description.json" not in members:
+            raise ISError("Metadata members not found")
+        return members
+
     @property
     def filename(self):
         '''
@@ -143,13 +313,38 @@ class PackageImage(Image):
         '''
         return u"%s-%s%s" % (self.name, self.version, self.extension)
 
-    def read_metadata(self):
+    def cache_metadata(self, members=None):
+        '''
+        Store metadata members in the persistent metadata cache
+        Only metadata of images whose md5 and size are verified must be stored
+        '''
+        if self.cache is None or self._cached:
+            return
+        if members is None:
+            members = dict((name, self._tarball.get_str(name))
+                           for name in self.metadata_members
+                           if self._tarball.has(name))
+        self.cache.set(self.md5, members)
+        self._cached = True
+
+    def read_metadata(self, members=None):
         '''
         Parse tarball and return metadata dict
+
+        members is an optional dict of metadata members content, used instead
+        of the tarball
         '''
+        if members is None:
+            get_utf8 = self._tarball.get_utf8
+        else:
+            def get_utf8(name):
+                try:
+                    return unicode(members[name], "UTF-8")
+                except UnicodeDecodeError:
+                    raise ISError(u"Invalid UTF-8 character in %s" % name)
         desc = {}
         # check format
-        img_format = self._tarball.get_utf8("format")
+        img_format = get_utf8("format")
         try:
             if float(img_format) >= floor(float(SourceImage.format)) + 1.0:
                 raise Exception()
@@ -158,7 +353,7 @@ class PackageImage(Image):
         desc["format"] = img_format
         # check description
         try:
-            img_desc = self._tarball.get_utf8("description.json")
+            img_desc = get_utf8("description.json")
             desc.update(loads(img_desc))
             self.check_name(desc["name"])
             self.check_version(desc["version"])
@@ -184,7 +379,7 @@ class PackageImage(Image):
             raise ISError(u"Invalid description", e)
         # try to load changelog
         try:
-            img_changelog = self._tarball.get_utf8("changelog")
+            img_changelog = get_utf8("changelog")
             desc["changelog"] = Changelog(img_changelog)
         except KeyError:
             desc["changelog"] = Changelog("")
@@ -252,6 +447,15 @@ class PackageImage(Image):
             pay_obj.check()
         arrowlevel(-1)
 
+    def embedded_bytecode(self, key):
+        '''
+        Return marshaled bytecode stored inside the image or None
+        '''
+        ti = self._tarball.get(u"bytecode/%s" % key)
+        if ti is None:
+            return None
+        return self._tarball.extractfile(ti).read()
+
     def cat(self, filename):
         '''
         Display filename in the tarball
@@ -263,6 +467,54 @@ class PackageImage(Image):
             arrow(filename)
             out(self._tarball.get_utf8(filename))
 
+    def convert(self, directory, force=False):
+        '''
+        Write the image in the current image format inside directory
+        Payloads are not modified
+        '''
+        if self.format == SourceImage.format:
+            warn(u"Image %s v%s is already in format %s" % (self.name,
+                                                           self.version,
+                                                           self.format))
+            return
+        directory = abspath(directory)
+        dest = join(directory, self.filename)
+        if not force and exists(dest):
+            raise ISError(u"Image destination already exists: %s" % dest)
+        arrow(u"Converting image %s v%s from format %s to %s in %s" % (
+            self.name, self.version, self.format, SourceImage.format, directory))
+        # one tarball section by top level directory
+        sections = []
+        tarballs = {}
+        for ti in self._tarball.getmembers():
+            if ti.name in self.metadata_members:
+                continue
+            top = ti.name.split("/", 1)[0]
+            if top not in tarballs:
+                memfile = StringIO()
+                tarballs[top] = (memfile, Tarball.open(fileobj=memfile, mode="w:"))
+                sections.append(top)
+            fo = self._tarball.extractfile(ti) if ti.isfile() else None
+            tarballs[top][1].addfile(ti, fo)
+        for memfile, tarball in tarballs.values():
+            tarball.close()
+        changelog = None
+        if self._tarball.has("changelog"):
+            changelog = self._tarball.get_utf8("changelog")
+        # write the image container
+        tmpdest = u"%s.tmp" % dest
+        try:
+            with open(tmpdest, "wb") as fo:
+                write_container(fo, SourceImage.format,
+                                self._tarball.get_str("description.json"),
+                                changelog,
+                                [(x, tarballs[x][0].getvalue()) for x in sections])
+            rename(tmpdest, dest)
+        except Exception as e:
+            if exists(tmpdest):
+                unlink(tmpdest)
+            raise ISError(u"Unable to convert image %s" % self.name, e)
+
     def download(self, directory, force=False, image=True, payload=False):
         '''
         Download image in directory
@@ -327,6 +579,69 @@ class PackageImage(Image):
                 arrow(u"Extracting payload %s in %s" % (payname, dest))
                 self.payload[payname].extract(dest, force=force)
 
+    def extract_payloads(self, payloads, jobs=None, force=False,
+                         background=False):
+        '''
+        Extract several payloads concurrently
+
+        payloads is a dict of destinations indexed by payload name
+        jobs is the maximum number of concurrent extractions (default: number
+        of cpu)
+        force will overwrite existing files
+
+        All extractions are finished before an error is raised. If background
+        is true, extraction runs in background and a PayloadsExtraction object
+        is returned, its wait method raise errors. Background extractions are
+        waited at the end of setup scripts.
+        '''
+        for name in payloads:
+            if name not in self.payload:
+                raise ISError(u"No such payload %s" % name)
+        items = sorted(payloads.items())
+        # progress bars of concurrent extractions would be mixed
+        progressbar = len(items) == 1 or jobs == 1
+        def extract((name, dest)):
+            try:
+                self.payload[name].extract(dest, force=force,
+                                           progressbar=progressbar)
+            except Exception as e:
+                return e
+        extract = bind(extract)
+        def extract_all():
+            errors = [e for e in parallel_imap(extract, items, jobs) if e is not None]
+            for e in errors[1:]:
+                warn(unicode(e))
+            if len(errors) > 0:
+                raise errors[0]
+        if not background:
+            return extract_all()
+        debug(u"Extracting payloads %s in background" % u", ".join(payloads))
+        extraction = PayloadsExtraction(extract_all)
+        self._extractions.append(extraction)
+        return extraction
+
+    def wait_payloads(self, warn_only=False):
+        '''
+        Wait for the end of all background payloads extractions
+
+        The first error is raised once all extractions are finished, others
+        are reported. If warn_only is true, all errors are reported.
+        '''
+        errors = []
+        while len(self._extractions) > 0:
+            try:
+                self._extractions.pop(0).wait()
+            except Exception as e:
+                errors.append(e)
+        if not warn_only and len(errors) > 0:
+            error = errors.pop(0)
+        else:
+            error = None
+        for e in errors:
+            warn(unicode(e))
+        if error is not None:
+            raise error
+
     def run(self, parser, extparser, load_modules=True, run_parser=True,
             run_setup=True):
         '''
@@ -356,16 +671,24 @@ class PackageImage(Image):
         # encode command line arguments to utf-8
         args = argv()[1:]
         # catch exception in custom argparse action
-        try:
-            args = parser.parse_args(args=args)
-        except Exception as e:
-            raise ISError("Argument parser", e)
+        with span("arguments"):
+            try:
+                args = parser.parse_args(args=args)
+            except Exception as e:
+                raise ISError("Argument parser", e)
         # run setup scripts
         if run_setup:
-            self.run_scripts("setup",
-                             lambda: self.select_scripts("setup"),
-                             "/",
-                             {"namespace": args})
+            try:
+                self.run_scripts("setup",
+                                 lambda: self.select_scripts("setup"),
+                                 "/",
+                                 {"namespace": args})
+            except:
+                # background extractions must not outlive a failed install,
+                # their errors are only reported
+                self.wait_payloads(warn_only=True)
+                raise
+            self.wait_payloads()
         # return the building time
         return int(time() - t0)
 
@@ -19,11 +19,13 @@
 from installsystems.exception import ISError
 from installsystems.image.image import Image
 from installsystems.printer import debug
+from installsystems.profiler import span, wait
 from installsystems.tools import PipeFile, mkdir
 from installsystems.tools import chrights, get_compressor_path
 from os import umask, listdir
 from os.path import join, isdir, exists, dirname
 from subprocess import Popen, PIPE
+from threading import Thread
 from time import time
 
 '''
@@ -196,21 +198,25 @@ class Payload(object):
         if self.md5 != fs.md5:
             raise ISError(u"Downloading payload %s failed: Invalid MD5" % self.name)
 
-    def extract(self, dest, force=False, filelist=None):
+    def extract(self, dest, force=False, filelist=None, progressbar=True):
         '''
         Extract payload into dest
         filelist is a filter of file in tarball
         force will overwrite existing file if exists
+        progressbar display the extraction progress
         '''
         try:
-            if self.isdir:
-                self.extract_tar(dest, force=force, filelist=filelist)
-            else:
-                self.extract_file(dest, force=force)
+            with span(u"payload %s" % self.name, size=self.size):
+                if self.isdir:
+                    self.extract_tar(dest, force=force, filelist=filelist,
+                                     progressbar=progressbar)
+                else:
+                    self.extract_file(dest, force=force,
+                                      progressbar=progressbar)
         except Exception as e:
             raise ISError(u"Extracting payload %s failed" % self.name, e)
 
-    def extract_tar(self, dest, force=False, filelist=None):
+    def extract_tar(self, dest, force=False, filelist=None, progressbar=True):
         '''
         Extract a payload which is a tarball.
         This is used mainly to extract payload from a directory
@@ -225,7 +231,7 @@ class Payload(object):
             mkdir(dest)
         # try to open payload file
         try:
-            fo = PipeFile(self.path, progressbar=True)
+            fo = PipeFile(self.path, progressbar=progressbar)
         except Exception as e:
             raise ISError(u"Unable to open %s" % self.path)
         # check if announced file size is good
@@ -238,6 +244,7 @@ class Payload(object):
         # add optionnal selected filename for decompression
         if filelist is not None:
             a_tar += filelist
+        t_start = time()
         p_tar = Popen(a_tar, shell=False, close_fds=True,
                       stdin=PIPE)
         p_comp = Popen(a_comp, shell=False, close_fds=True,
@@ -245,7 +252,8 @@ class Payload(object):
         # close tar fd
         p_tar.stdin.close()
         # push data into compressor
-        fo.consume(p_comp.stdin)
+        with span("transfer"):
+            fo.consume(p_comp.stdin)
         # close source fd
         fo.close()
         # checking downloaded size
@@ -257,13 +265,13 @@ class Payload(object):
         # close compressor pipe
         p_comp.stdin.close()
         # check compressor return 0
-        if p_comp.wait() != 0:
+        if wait(p_comp, u"decompress %s" % self.compressor, t_start) != 0:
             raise ISError(u"Compressor %s return is not zero" % a_comp[0])
         # check tar return 0
-        if p_tar.wait() != 0:
+        if wait(p_tar, "tar extract", t_start) != 0:
             raise ISError("Tar return is not zero")
 
-    def extract_file(self, dest, force=False):
+    def extract_file(self, dest, force=False, progressbar=True):
         '''
         Copy a payload directly to a file
         Check md5 on the fly
@@ -284,7 +292,7 @@ class Payload(object):
         a_comp = get_compressor_path(self.compressor, compress=False)
         # try to open payload file (source)
         try:
-            f_src = PipeFile(self.path, "r", progressbar=True)
+            f_src = PipeFile(self.path, "r", progressbar=progressbar)
         except Exception as e:
             raise ISError(u"Unable to open payload file %s" % self.path, e)
         # check if announced file size is good
@@ -296,12 +304,14 @@ class Payload(object):
         except Exception as e:
             raise ISError(u"Unable to open destination file %s" % dest, e)
         # run compressor process
+        t_start = time()
         p_comp = Popen(a_comp, shell=False, close_fds=True,
                        stdin=PIPE, stdout=f_dst)
         # close destination file
         f_dst.close()
         # push data into compressor
-        f_src.consume(p_comp.stdin)
+        with span("transfer"):
+            f_src.consume(p_comp.stdin)
         # closing source fo
         f_src.close()
         # checking download size
@@ -313,7 +323,42 @@ class Payload(object):
         # close compressor pipe
         p_comp.stdin.close()
         # check compressor return 0
-        if p_comp.wait() != 0:
+        if wait(p_comp, u"decompress %s" % self.compressor, t_start) != 0:
             raise ISError(u"Compressor %s return is not zero" % a_comp[0])
         # settings file orginal rights
         chrights(dest, self.uid, self.gid, self.mode, self.mtime)
+
+
+class PayloadsExtraction(object):
+    '''
+    PayloadsExtraction class represents payloads extracted in background
+    '''
+
+    def __init__(self, func):
+        self.error = None
+        self._thread = Thread(target=self._run, args=(func,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func):
+        try:
+            func()
+        except Exception as e:
+            self.error = e
+
+    @property
+    def done(self):
+        '''
+        Return True when extraction is finished
+        '''
+        return not self._thread.is_alive()
+
+    def wait(self):
+        '''
+        Wait for the end of extraction and raise its error, if any
+        '''
+        # waiting with a timeout let KeyboardInterrupt be raised
+        while self._thread.is_alive():
+            self._thread.join(1)
+        if self.error is not None:
+            raise self.error
@@ -26,15 +26,21 @@ from configobj import ConfigObj, flatten_errors
 from installsystems import VERSION
 from installsystems.exception import ISError, InvalidSourceImage
 from installsystems.image.changelog import Changelog
+from installsystems.image.container import write_container
 from installsystems.image.image import Image
 from installsystems.image.payload import Payload
 from installsystems.image.tarball import Tarball, REGTYPE
 from installsystems.printer import arrow, arrowlevel, warn, error
 from installsystems.tools import PipeFile, isfile, get_compressor_path, chrights
+from installsystems.tools import human_size, parallel_imap, COMPRESSOR_MAGICS
+from cStringIO import StringIO
+from itertools import izip
 from json import dumps
 from locale import getpreferredencoding
-from os import stat, listdir, mkdir, umask, access, unlink, symlink, R_OK, X_OK
-from os.path import join, exists, isdir, abspath, lexists, basename
+from multiprocessing import cpu_count
+from os import stat, listdir, mkdir, umask, access, unlink, symlink, devnull
+from os import R_OK, X_OK
+from os.path import join, exists, isdir, abspath, lexists, basename, getsize
 from re import match
 from stat import S_ISDIR, S_IMODE
 from subprocess import Popen, PIPE
@@ -43,6 +49,8 @@ from validate import Validator
 
 # use module prefix because function is named open
 import codecs
+# use module prefix because dumps is the json one
+import marshal
 # use module prefix because function is named filter
 import fnmatch
 
@@ -54,7 +62,11 @@ class SourceImage(Image):
 
     # format should be a float  X.Y but for compatibility reason it's a string
     # before version 6, it's strict string comparaison
-    format = "2.0"
+    # since format 3, images are containers (see installsystems.image.container)
+    format = "3.0"
+
+    # formats which can be built, the last one being the default
+    formats = ("2.0", "3.0")
 
 
     @classmethod
@@ -94,7 +106,7 @@ class SourceImage(Image):
                 "description": "",
                 "author": "",
                 "is_min_version": VERSION,
-                "compressor": "gzip = *\nnone = *.gz, *.bz2, *.xz"}
+                "compressor": "gzip = *\nnone = *.gz, *.bz2, *.xz, *.zst, *.lz4"}
         }
         # create changelog example from template
         examples["changelog"] = {"path": "changelog", "content": CHANGELOG_TPL}
@@ -126,11 +138,21 @@ class SourceImage(Image):
             raise ISError(u"Unable to set rights", e)
         arrowlevel(-1)
 
+    # candidates of the auto compressor, by order of preference
+    auto_compressors = ("none", "lz4", "zstd", "gzip", "xz", "bzip2")
+
+    # size of payloads samples measured by the auto compressor
+    auto_sample_size = 8 * 1024 * 1024 # 8MiB
+
     def __init__(self, path):
         '''
         Initialize source image
         '''
         Image.__init__(self)
+        # compressors chosen by the auto compressor, by payload
+        self.auto_choices = {}
+        # md5 and size of payloads created by this build, by payload
+        self.payload_checksums = {}
         # check local repository
         if not isfile(path):
             raise NotImplementedError("SourceImage must be local")
@@ -170,10 +192,18 @@ class SourceImage(Image):
                 if not access(d, R_OK|X_OK):
                     raise InvalidSourceImage(u"unable to access to %s." % d)
 
-    def build(self, force=False, force_payload=False, check=True, script=True):
+    def build(self, force=False, force_payload=False, check=True, script=True,
+              bytecode=False, jobs=None, img_format=None):
         '''
         Create packaged image
-        '''
+        if bytecode is true, compiled scripts are embedded inside the image
+        jobs is the number of payloads created in parallel
+        img_format is the image format to build, by default the current one
+        '''
+        if img_format is not None:
+            if img_format not in self.formats:
+                raise ISError(u"Unable to build image format %s" % img_format)
+            self.format = img_format
         # check if free to create script tarball
         if exists(self.image_name):
             if force:
@@ -183,11 +213,12 @@ class SourceImage(Image):
         # register start time
         t0 = time()
         # check python scripts
-        if check:
+        bytecode = {} if bytecode else None
+        if check or bytecode is not None:
             for d in (self.build_path, self.parser_path, self.setup_path,
                       self.lib_path):
                 if exists(d):
-                    self.check_scripts(d)
+                    self.check_scripts(d, bytecode)
         # load modules
         self.load_modules(lambda: self.select_scripts(self.lib_path))
         # remove list
@@ -200,17 +231,27 @@ class SourceImage(Image):
         # remove payloads
         self.remove_payloads(rl)
         # create payload files
-        self.create_payloads()
+        self.create_payloads(jobs)
         # generate a json description
         jdesc = self.generate_json_description()
         # creating scripts tarball
-        self.create_image(jdesc)
+        self.create_image(jdesc, bytecode)
         # compute building time
         return int(time() - t0)
 
-    def create_image(self, jdescription):
+    def create_image(self, jdescription, bytecode=None):
+        '''
+        Create an image in current directory, in the image format
+        bytecode is an optional dict of marshaled bytecode by key
+        '''
+        if self.format == "2.0":
+            self.create_image_tarball(jdescription, bytecode)
+        else:
+            self.create_image_container(jdescription, bytecode)
+
+    def create_image_tarball(self, jdescription, bytecode=None):
         '''
-        Create a script tarball in current directory
+        Create a script tarball in current directory (format 2)
         '''
         # create tarball
         arrow("Creating image tarball")
@@ -237,6 +278,11 @@ class SourceImage(Image):
             for d in (self.build_path, self.parser_path, self.lib_path):
                 if exists(d):
                     self.add_scripts(tarball, d)
+            # add compiled scripts
+            if bytecode:
+                arrow("Add bytecode")
+                for key, data in sorted(bytecode.items()):
+                    tarball.add_str(u"bytecode/%s" % key, data, REGTYPE, 0644)
             # closing tarball file
             tarball.close()
         except (SystemExit, KeyboardInterrupt):
@@ -244,6 +290,54 @@ class SourceImage(Image):
                 unlink(self.image_name)
         arrowlevel(-1)
 
+    def create_image_container(self, jdescription, bytecode=None):
+        '''
+        Create an image container in current directory (format 3)
+        '''
+        arrow("Creating image container")
+        arrowlevel(1)
+        arrow(u"Name %s" % self.image_name)
+        try:
+            # create a tarball section by scripts directory
+            sections = []
+            for d in (self.setup_path, self.build_path, self.parser_path,
+                      self.lib_path):
+                if d != self.setup_path and not exists(d):
+                    continue
+                memfile = StringIO()
+                tarball = Tarball.open(fileobj=memfile, mode="w:", dereference=True)
+                self.add_scripts(tarball, d)
+                tarball.close()
+                sections.append((basename(d), memfile.getvalue()))
+            # add compiled scripts
+            if bytecode:
+                arrow("Add bytecode")
+                memfile = StringIO()
+                tarball = Tarball.open(fileobj=memfile, mode="w:")
+                for key, data in sorted(bytecode.items()):
+                    tarball.add_str(u"bytecode/%s" % key, data, REGTYPE, 0644)
+                tarball.close()
+                sections.append(("bytecode", memfile.getvalue()))
+            # add changelog
+            changelog = None
+            if self.changelog is not None:
+                arrow("Add changelog")
+                changelog = self.changelog.verbatim
+            # write container
+            arrow("Add description and sections")
+            try:
+                with open(self.image_name, "wb") as fo:
+                    write_container(fo, self.format, jdescription, changelog,
+                                    sections)
+            except Exception as e:
+                if exists(self.image_name):
+                    unlink(self.image_name)
+                raise ISError(u"Unable to create image %s" % self.image_name, e)
+        except (SystemExit, KeyboardInterrupt):
+            if exists(self.image_name):
+                unlink(self.image_name)
+        arrowlevel(-1)
+
     def describe_payload(self, name):
         '''
         Return information about a payload
@@ -264,6 +358,9 @@ class SourceImage(Image):
         ans["mode"] = S_IMODE(source_stat.st_mode)
         ans["mtime"] = source_stat.st_mtime
         ans["compressor"] = self.compressor(name)
+        if ans["compressor"] == "auto":
+            ans["compressor"] = self.auto_compressor(name, ans["dest_path"])
+        ans["level"], ans["threads"] = self.compression(name)
         return ans
 
     def select_payloads(self):
@@ -282,58 +379,102 @@ class SourceImage(Image):
         arrow("Removing payloads")
         for pay in paylist:
             arrow(pay, 1)
-            desc = self.describe_payload(pay)
-            for f in (desc["dest_path"], desc["link_path"]):
-                if lexists(f):
-                    unlink(f)
+            self.remove_payload_files(self.describe_payload(pay))
 
-    def create_payloads(self):
+    def create_payloads(self, jobs=None):
         '''
         Create all missing data payloads in current directory
-        Doesn't compute md5 during creation because tarball can
-        be created manually
+        Payloads are created by a pool of jobs threads (default: number of cpu)
+        md5 and size of created payloads are computed during creation, the
+        other ones are computed later because tarball can be created manually
         Also create symlink to versionned payload
         '''
         arrow("Creating payloads")
+        paydescs = []
         for payload_name in self.select_payloads():
             paydesc = self.describe_payload(payload_name)
-            if exists(paydesc["link_path"]):
-                continue
-            arrow(payload_name, 1)
+            if not exists(paydesc["link_path"]):
+                paydescs.append((payload_name, paydesc))
+        # progress bars of concurrent pipelines would be mixed, so concurrent
+        # payloads are displayed when they are created
+        concurrent = len(paydescs) > 1 and (jobs or cpu_count()) > 1
+        def create((payload_name, paydesc)):
+            if not concurrent:
+                arrow(payload_name, 1)
             try:
-                # create non versionned payload file
-                if not exists(paydesc["dest_path"]):
-                    if paydesc["isdir"]:
-                        self.create_payload_tarball(paydesc["dest_path"],
-                                                    paydesc["source_path"],
-                                                    paydesc["compressor"])
-                    else:
-                        self.create_payload_file(paydesc["dest_path"],
-                                                 paydesc["source_path"],
-                                                 paydesc["compressor"])
-                # create versionned payload file
-                if lexists(paydesc["link_path"]):
-                    unlink(paydesc["link_path"])
-                symlink(paydesc["dest_path"], paydesc["link_path"])
+                self.create_payload(payload_name, paydesc,
+                                    progressbar=not concurrent)
             except Exception as e:
-                # cleaning file in case of error
-                if exists(paydesc["dest_path"]):
-                    unlink(paydesc["dest_path"])
-                if lexists(paydesc["link_path"]):
-                    unlink(paydesc["link_path"])
-                raise ISError(u"Unable to create payload %s" % payload_name, e)
+                return e
+        pending = dict(paydescs)
+        errors = []
+        try:
+            for (payload_name, paydesc), err in izip(paydescs,
+                                                     parallel_imap(create, paydescs, jobs)):
+                del pending[payload_name]
+                if err is not None:
+                    errors.append(err)
+                elif concurrent and payload_name in self.payload_checksums:
+                    arrow(u"%s (%s)" % (payload_name,
+                          human_size(self.payload_checksums[payload_name][1])), 1)
+                elif concurrent:
+                    arrow(payload_name, 1)
+        except (SystemExit, KeyboardInterrupt):
+            # remove partial payloads of running and waiting pipelines
+            for paydesc in pending.values():
+                self.remove_payload_files(paydesc)
+            raise
+        for err in errors[1:]:
+            warn(unicode(err))
+        if len(errors) > 0:
+            raise errors[0]
+
+    def create_payload(self, payload_name, paydesc, progressbar=True):
+        '''
+        Create a payload file and the symlink to its versionned name
+        '''
+        try:
+            # create non versionned payload file
+            if not exists(paydesc["dest_path"]):
+                if paydesc["isdir"]:
+                    create = self.create_payload_tarball
+                else:
+                    create = self.create_payload_file
+                self.payload_checksums[payload_name] = create(
+                    paydesc["dest_path"], paydesc["source_path"],
+                    paydesc["compressor"], paydesc["level"], paydesc["threads"],
+                    progressbar)
+            # create versionned payload file
+            if lexists(paydesc["link_path"]):
+                unlink(paydesc["link_path"])
+            symlink(paydesc["dest_path"], paydesc["link_path"])
+        except Exception as e:
+            # cleaning file in case of error
+            self.remove_payload_files(paydesc)
+            raise ISError(u"Unable to create payload %s" % payload_name, e)
 
-    def create_payload_tarball(self, tar_path, data_path, compressor):
+    def remove_payload_files(self, paydesc):
+        '''
+        Remove payload file and its versionned symlink if exist
+        '''
+        for f in (paydesc["dest_path"], paydesc["link_path"]):
+            if lexists(f):
+                unlink(f)
+
+    def create_payload_tarball(self, tar_path, data_path, compressor,
+                               level=None, threads=None, progressbar=True):
         '''
         Create a payload tarball
+        Return md5 and size of the created tarball
         '''
         try:
             # get compressor argv (first to escape file creation if not found)
-            a_comp = get_compressor_path(compressor, compress=True)
+            a_comp = get_compressor_path(compressor, compress=True,
+                                         level=level, threads=threads)
             a_tar = ["tar", "--create", "--numeric-owner", "--directory",
                      data_path, "."]
             # create destination file
-            f_dst = PipeFile(tar_path, "w", progressbar=True)
+            f_dst = PipeFile(tar_path, "w", progressbar=progressbar)
             # run tar process
             p_tar = Popen(a_tar, shell=False, close_fds=True,
                           stdout=PIPE)
@@ -352,22 +493,26 @@ class SourceImage(Image):
             # check compressor return 0
             if p_comp.wait() != 0:
                 raise ISError(u"Compressor %s return is not zero" % a_comp[0])
+            return f_dst.md5, f_dst.write_size
         except (SystemExit, KeyboardInterrupt):
             if exists(tar_path):
                 unlink(tar_path)
             raise
 
-    def create_payload_file(self, dest, source, compressor):
+    def create_payload_file(self, dest, source, compressor, level=None,
+                            threads=None, progressbar=True):
         '''
         Create a payload file
+        Return md5 and size of the created file
         '''
         try:
             # get compressor argv (first to escape file creation if not found)
-            a_comp = get_compressor_path(compressor, compress=True)
+            a_comp = get_compressor_path(compressor, compress=True,
+                                         level=level, threads=threads)
             # open source file
             f_src = open(source, "r")
             # create destination file
-            f_dst = PipeFile(dest, "w", progressbar=True)
+            f_dst = PipeFile(dest, "w", progressbar=progressbar)
             # run compressor
             p_comp = Popen(a_comp, shell=False, close_fds=True,
                            stdin=f_src, stdout=PIPE)
@@ -381,6 +526,7 @@ class SourceImage(Image):
             # check compressor return 0
             if p_comp.wait() != 0:
                 raise ISError(u"Compressor %s return is not zero" % a_comp[0])
+            return f_dst.md5, f_dst.write_size
         except (SystemExit, KeyboardInterrupt):
             if exists(dest):
                 unlink(dest)
@@ -440,9 +586,11 @@ class SourceImage(Image):
             arrow(u"%s added" % fn)
         arrowlevel(-1)
 
-    def check_scripts(self, directory):
+    def check_scripts(self, directory, bytecode=None):
         '''
         Check if scripts inside a directory can be compiled
+        If bytecode is a dict, marshaled bytecode of image scripts are stored
+        inside, compiled with the filename they have when the image is run
         '''
         basedirectory = basename(directory)
         arrow(u"Checking %s scripts" % basedirectory)
@@ -455,9 +603,19 @@ class SourceImage(Image):
             assert(isinstance(fc, str))
             arrow(fn)
             try:
-                compile(fc, fn.encode(getpreferredencoding()), "exec")
+                code = compile(fc, fn.encode(getpreferredencoding()), "exec")
             except SyntaxError as e:
                 raise ISError(exception=e)
+            # build scripts are not run from packaged images
+            if bytecode is None or directory == self.build_path:
+                continue
+            # lib modules are loaded with their path inside the image
+            if directory == self.lib_path:
+                filename = join(basedirectory, fn).encode(getpreferredencoding())
+                code = compile(fc, filename, "exec")
+            else:
+                filename = fn.encode(getpreferredencoding())
+            bytecode[self.bytecode_key(fc, filename)] = marshal.dumps(code)
         arrowlevel(-1)
 
     def run_build(self):
@@ -481,6 +639,9 @@ class SourceImage(Image):
         desc = self.description.copy()
         # only store compressor patterns
         desc["compressor"] = desc["compressor"]["patterns"]
+        # compression settings are only used to build payloads
+        del desc["compression"]
+        del desc["auto_policy"]
         # timestamp image
         arrow("Timestamping")
         desc["date"] = int(time())
@@ -493,14 +654,18 @@ class SourceImage(Image):
             arrow(payload_name, 1)
             # getting payload info
             payload_desc = self.describe_payload(payload_name)
-            # compute md5 and size
-            fileobj = PipeFile(payload_desc["link_path"], "r")
-            fileobj.consume()
-            fileobj.close()
+            # compute md5 and size, unless computed during creation
+            if payload_name in self.payload_checksums:
+                md5, size = self.payload_checksums[payload_name]
+            else:
+                fileobj = PipeFile(payload_desc["link_path"], "r")
+                fileobj.consume()
+                fileobj.close()
+                md5, size = fileobj.md5, fileobj.size
             # create payload entry
             desc["payload"][payload_name] = {
-                "md5": fileobj.md5,
-                "size": fileobj.size,
+                "md5": md5,
+                "size": size,
                 "isdir": payload_desc["isdir"],
                 "uid": payload_desc["uid"],
                 "gid": payload_desc["gid"],
@@ -508,6 +673,11 @@ class SourceImage(Image):
                 "mtime": payload_desc["mtime"],
                 "compressor": payload_desc["compressor"]
                 }
+            # explain auto compressor choice
+            if self.compressor(payload_name) == "auto":
+                desc["payload"][payload_name]["compressor_auto"] = \
+                    self.auto_choices.get(payload_name, {
+                        "policy": self.description["auto_policy"][0]})
         arrowlevel(-1)
         # check md5 are uniq
         md5s = [v["md5"] for v in desc["payload"].values()]
@@ -534,12 +704,12 @@ class SourceImage(Image):
             # If everything is fine, the validation return True
             # Else, it returns a list of (section, optname, error)
             if res is not True:
-                for section, optname, error in flatten_errors(cp, res):
-                    # If error is False, this mean no value as been supplied,
+                for section, optname, err in flatten_errors(cp, res):
+                    # If err is False, this mean no value as been supplied,
                     # so we use the default value
                     # Else, the check has failed
-                    if error:
-                        error('Wrong description file, %s %s: %s' % (section, optname, error))
+                    if err:
+                        error('Wrong description file, %s %s: %s' % (section, optname, err))
             for n in ("name","version", "description", "author", "is_min_version"):
                 d[n] = cp["image"][n]
             d["compressor"] = {}
@@ -549,10 +719,43 @@ class SourceImage(Image):
                 d["compressor"]["patterns"] = [(Image.default_compressor, "*")]
             for compressor, patterns in cp["compressor"].items():
                 # is a valid compressor?
-                get_compressor_path(compressor)
+                if compressor != "auto":
+                    get_compressor_path(compressor)
                 for pattern in patterns:
                     for payname in fnmatch.filter(self.select_payloads(), pattern):
                         d["compressor"][payname] = compressor
+            # older installsystems are not able to extract payloads of
+            # recent compressors
+            for payname, compressor in d["compressor"].items():
+                if payname == "patterns":
+                    continue
+                min_version = Image.compressors_min_version.get(compressor)
+                if (min_version is not None and
+                    Image.compare_versions(d["is_min_version"], min_version) < 0):
+                    warn(u"Minimum Installsystems version raised to %s by "
+                         "compressor %s" % (min_version, compressor))
+                    d["is_min_version"] = min_version
+            # set payload compression level and threads, by pattern
+            d["compression"] = {}
+            compression = cp["compression"]
+            for pattern in compression.sections:
+                settings = compression[pattern]
+                for payname in fnmatch.filter(self.select_payloads(), pattern):
+                    d["compression"][payname] = (settings["level"],
+                                                 settings["threads"])
+            for payname, (level, threads) in d["compression"].items():
+                compressor = d["compressor"].get(payname, Image.default_compressor)
+                # auto compressor candidates are measured with default level
+                if compressor == "auto":
+                    if level is not None:
+                        warn(u"Compression level of payload %s ignored by "
+                             "auto compressor" % payname)
+                        d["compression"][payname] = (None, threads)
+                    continue
+                # is a valid level for the payload compressor?
+                get_compressor_path(compressor, level=level, threads=threads)
+            # auto compressor policy and transfer bandwidth
+            d["auto_policy"] = (compression["policy"], compression["bandwidth"])
         except Exception as e:
             raise ISError(u"Bad description", e)
         return d
@@ -585,6 +788,141 @@ class SourceImage(Image):
             # set default compressor if no compressor is specified
             return Image.default_compressor
 
+    def auto_compressor(self, payname, dest_path):
+        '''
+        Return the compressor of a payload using the auto compressor
+        The compressor of an already built payload is detected from its file,
+        otherwise candidates are measured on a sample of the payload and the
+        best one according to the policy is chosen
+        '''
+        if payname in self.auto_choices:
+            return self.auto_choices[payname]["compressor"]
+        if exists(dest_path):
+            return self.detect_compressor(payname, dest_path)
+        policy, bandwidth = self.description["auto_policy"]
+        arrow(u"Choosing compressor of payload %s (%s policy)" % (payname, policy), 1)
+        sample = self.sample_payload(payname)
+        if len(sample) == 0:
+            arrow(u"Empty payload, using %s" % Image.default_compressor, 2)
+            self.auto_choices[payname] = {"compressor": Image.default_compressor,
+                                          "policy": policy}
+            return Image.default_compressor
+        candidates = {}
+        for compressor in self.auto_compressors:
+            # skip compressors unavailable on this host or at install
+            min_version = Image.compressors_min_version.get(compressor)
+            if (min_version is not None and Image.compare_versions(
+                    self.description["is_min_version"], min_version) < 0):
+                continue
+            # no compression has nothing to measure
+            if compressor == "none":
+                arrow(u"none: ratio 100.0%", 2)
+                candidates["none"] = {"ratio": 1.0, "compression": None,
+                                      "decompression": None}
+                continue
+            try:
+                ratio, cspeed, dspeed = self.measure_compressor(compressor, sample)
+            except ISError:
+                continue
+            arrow(u"%s: ratio %.1f%%, compression %s/s, decompression %s/s" %
+                  (compressor, ratio * 100, human_size(cspeed), human_size(dspeed)), 2)
+            candidates[compressor] = {"ratio": ratio,
+                                      "compression": int(cspeed),
+                                      "decompression": int(dspeed)}
+        # cost of a candidate is the time to transfer or decompress a byte
+        def cost(compressor):
+            c = candidates[compressor]
+            decompression = 1.0 / c["decompression"] if c["decompression"] else 0
+            transfer = c["ratio"] / (bandwidth * 1048576.0)
+            if policy == "size":
+                return c["ratio"]
+            # payloads are transfered and decompressed in a pipeline, the
+            # slowest of both bounds the extraction
+            if policy == "speed":
+                return max(transfer, decompression)
+            return transfer + decompression
+        if len(candidates) == 0:
+            raise ISError(u"No compressor available for payload %s" % payname)
+        choice = min((c for c in self.auto_compressors if c in candidates), key=cost)
+        arrow(u"Selected %s" % choice, 2)
+        self.auto_choices[payname] = {"compressor": choice, "policy": policy,
+                                      "candidates": candidates}
+        return choice
+
+    def detect_compressor(self, payname, dest_path):
+        '''
+        Return the compressor of a built payload file
+        '''
+        source_path = join(self.payload_path, payname)
+        with open(dest_path, "rb") as fo:
+            head = fo.read(8)
+        # uncompressed files are copied
+        if not isdir(source_path) and getsize(source_path) == getsize(dest_path):
+            with open(source_path, "rb") as fo:
+                if fo.read(8) == head:
+                    return "none"
+        for compressor, magic in COMPRESSOR_MAGICS.items():
+            if head.startswith(magic):
+                return compressor
+        return "none"
+
+    def sample_payload(self, payname):
+        '''
+        Return a sample of a payload of at most auto_sample_size bytes
+        Directories are sampled from the start of their tarball and files
+        from evenly spaced chunks
+        '''
+        path = join(self.payload_path, payname)
+        if isdir(path):
+            # tar is stopped by a broken pipe once the sample is read, so its
+            # error message and exit status are ignored
+            with open(devnull, "wb") as null:
+                p_tar = Popen(["tar", "--create", "--numeric-owner",
+                               "--directory", path, "."], shell=False,
+                              close_fds=True, stdout=PIPE, stderr=null)
+                sample = p_tar.stdout.read(self.auto_sample_size)
+                p_tar.stdout.close()
+                p_tar.wait()
+            return sample
+        chunk = 1048576 # 1MiB
+        count = self.auto_sample_size / chunk
+        size = getsize(path)
+        with open(path, "rb") as fo:
+            if size <= self.auto_sample_size:
+                return fo.read()
+            sample = []
+            for i in range(count):
+                fo.seek(i * (size - chunk) / (count - 1))
+                sample.append(fo.read(chunk))
+        return "".join(sample)
+
+    def measure_compressor(self, compressor, sample):
+        '''
+        Return compression ratio, compression and decompression speeds
+        (bytes by second) of a compressor on a sample
+        '''
+        def run(argv, data):
+            p = Popen(argv, shell=False, close_fds=True, stdin=PIPE, stdout=PIPE)
+            out = p.communicate(data)[0]
+            if p.returncode != 0:
+                raise ISError(u"Compressor %s return is not zero" % argv[0])
+            return out
+        t0 = time()
+        data = run(get_compressor_path(compressor), sample)
+        t1 = time()
+        run(get_compressor_path(compressor, compress=False), data)
+        t2 = time()
+        return (float(len(data)) / len(sample),
+                len(sample) / max(t1 - t0, 1e-6),
+                len(sample) / max(t2 - t1, 1e-6))
+
+    def compression(self, payname):
+        '''
+        Return payload compression level and threads
+        None means the compressor default
+        '''
+        return self.description["compression"].get(payname, (None, None))
+
 
 DESCRIPTION_TPL = u"""[image]
 name = %(name)s
@@ -667,4 +1005,11 @@ is_min_version = IS_min_version
 
 [compressor]
 __many__ = force_list
+
+[compression]
+policy = option("size", "speed", "balanced", default="balanced")
+bandwidth = integer(1, default=100)
+    [[__many__]]
+    level = integer(0, 22, default=None)
+    threads = integer(0, default=None)
 """
@@ -19,7 +19,7 @@
 from StringIO import StringIO
 from installsystems.exception import ISError
 from os import chown, lchown
-from re import match
+from re import compile
 from sys import platform
 from tarfile import TarFile, TarInfo, REGTYPE, ExtractError
 from time import time
@@ -32,8 +32,78 @@ import fnmatch
 class Tarball(TarFile):
     '''
     Tarball wrapper
+    Members are indexed by name on first query, so member lookups don't scan
+    the member list
     '''
 
+    # compiled regexp patterns, by pattern
+    _patterns = {}
+
+    def __init__(self, *args, **kwargs):
+        self._index = None
+        super(Tarball, self).__init__(*args, **kwargs)
+
+    @property
+    def index(self):
+        '''
+        Return a dict of members TarInfo indexed by name
+        '''
+        if self._index is None:
+            # as getmember, the last occurrence of a name wins
+            self._index = dict((ti.name, ti) for ti in self.getmembers())
+        return self._index
+
+    def addfile(self, tarinfo, fileobj=None):
+        '''
+        Add a file and invalidate members index
+        '''
+        self._index = None
+        super(Tarball, self).addfile(tarinfo, fileobj)
+
+    def getmember(self, name):
+        '''
+        Return TarInfo of member name, raise KeyError if not found
+        '''
+        try:
+            return self.index[name]
+        except KeyError:
+            raise KeyError("filename %r not found" % name)
+
+    def has(self, name):
+        '''
+        Return True if member name exists
+        '''
+        if isinstance(name, unicode):
+            name = name.encode("UTF-8")
+        return name in self.index
+
+    def get(self, name):
+        '''
+        Return TarInfo of member name or None if not found
+        '''
+        if isinstance(name, unicode):
+            name = name.encode("UTF-8")
+        return self.index.get(name)
+
+    def iter_by_prefix(self, prefix):
+        '''
+        Iterate over TarInfo of members which names start with prefix
+        '''
+        if isinstance(prefix, unicode):
+            prefix = prefix.encode("UTF-8")
+        for ti in self.getmembers():
+            if ti.name.startswith(prefix):
+                yield ti
+
+    @classmethod
+    def _pattern(cls, pattern):
+        '''
+        Return a compiled regexp pattern
+        '''
+        if pattern not in cls._patterns:
+            cls._patterns[pattern] = compile(pattern)
+        return cls._patterns[pattern]
+
     def add_str(self, name, content, ftype, mode, mtime=None,
                 uid=None, gid=None, uname=None, gname=None):
         '''
@@ -80,13 +150,14 @@ class Tarball(TarFile):
         names = super(Tarball, self).getnames()
         # regexp matching
         if re_pattern is not None:
-            names = filter(lambda x: match(re_pattern, x), names)
+            names = filter(self._pattern(re_pattern).match, names)
         # globbing matching
         if glob_pattern is not None:
             names = fnmatch.filter(names, glob_pattern)
         # dir filering
         if not dir:
-            names = filter(lambda x: not self.getmember(x).isdir(), names)
+            index = self.index
+            names = filter(lambda x: not index[x].isdir(), names)
         # unicode encoding
         return map(lambda x: unicode(x, "UTF-8"), names)
 
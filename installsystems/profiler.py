@@ -0,0 +1,211 @@
+# -*- python -*-
+# -*- coding: utf-8 -*-
+
+# This file is part of Installsystems.
+#
+# Installsystems is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Installsystems is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Installsystems.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+InstallSystems profiler module
+
+Spans are recorded only when a profiler is started, otherwise span, add_bytes
+and wait cost nearly nothing.
+'''
+
+from contextlib import contextmanager
+from installsystems.exception import ISError
+from json import dump
+from os import wait4
+from resource import getrusage, error as ResourceError
+from threading import local
+from time import time
+
+# getrusage value selecting the calling thread (linux only)
+RUSAGE_THREAD = 1
+
+# current profiler
+PROFILER = None
+
+class Profiler(object):
+    '''
+    Record a tree of nested spans with wall time, cpu time and bytes moved
+    Cpu time of a span is the one of the thread running it, or None when
+    thread cpu time is not available. External processes (decompressors,
+    tar) are recorded as spans by wait.
+    Each thread has its own stack of spans, starting at the root span.
+    '''
+
+    def __init__(self, name):
+        self.t0 = time()
+        self.root = self._new(name)
+        self.local = local()
+
+    @property
+    def stack(self):
+        '''
+        Return the stack of spans of the current thread
+        '''
+        if not hasattr(self.local, "stack"):
+            self.local.stack = [self.root]
+        return self.local.stack
+
+    def _new(self, name, **attrs):
+        '''
+        Return a new started span
+        '''
+        span = {"name": name, "start": time() - self.t0, "wall": 0.0,
+                "cpu": 0.0, "bytes": 0, "children": []}
+        span.update(attrs)
+        span["_cpu"] = _cpu()
+        return span
+
+    def _end(self, span):
+        '''
+        Stop a span
+        '''
+        span["wall"] = time() - self.t0 - span["start"]
+        start, end = span.pop("_cpu"), _cpu()
+        span["cpu"] = None if start is None or end is None else end - start
+
+    @contextmanager
+    def span(self, name, **attrs):
+        '''
+        Record a span nested in the current one
+        '''
+        span = self._new(name, **attrs)
+        parent = self.stack[-1]
+        parent["children"].append(span)
+        self.stack.append(span)
+        try:
+            yield span
+        finally:
+            self.stack.pop()
+            self._end(span)
+            parent["bytes"] += span["bytes"]
+
+    def add_bytes(self, count):
+        '''
+        Add count bytes moved to the current span
+        '''
+        self.stack[-1]["bytes"] += count
+
+    def add_process(self, name, start, rusage):
+        '''
+        Add an external process span in the current span
+        '''
+        span = {"name": name, "start": start - self.t0,
+                "wall": time() - start,
+                "cpu": rusage.ru_utime + rusage.ru_stime,
+                "bytes": 0, "children": [], "process": True}
+        self.stack[-1]["children"].append(span)
+
+    def stop(self):
+        '''
+        Stop the root span
+        '''
+        if "_cpu" in self.root:
+            self._end(self.root)
+
+    def folded(self):
+        '''
+        Return spans as folded stacks (flamegraph.pl input), with self wall
+        time in microseconds
+        '''
+        lines = []
+        def fold(span, path):
+            path = path + [span["name"].replace(";", ":").replace(" ", "_")]
+            own = span["wall"] - sum(c["wall"] for c in span["children"]
+                                     if not c.get("process"))
+            lines.append(u"%s %d" % (u";".join(path), max(own, 0) * 1000000))
+            for child in span["children"]:
+                fold(child, path)
+        fold(self.root, [])
+        return u"\n".join(lines) + u"\n"
+
+    def write(self, path):
+        '''
+        Write the report in path
+        Report is folded stacks if path ends with .folded, JSON otherwise
+        '''
+        self.stop()
+        try:
+            with open(path, "w") as fo:
+                if path.endswith(".folded"):
+                    fo.write(self.folded().encode("UTF-8"))
+                else:
+                    dump(self.root, fo, indent=2)
+        except Exception as e:
+            raise ISError(u"Unable to write profile report %s" % path, e)
+
+
+def _cpu():
+    '''
+    Return cpu time of the calling thread, or None if not available
+    '''
+    try:
+        usage = getrusage(RUSAGE_THREAD)
+    except (ValueError, ResourceError):
+        return None
+    return usage.ru_utime + usage.ru_stime
+
+def start(name):
+    '''
+    Start profiling and return the profiler
+    '''
+    global PROFILER
+    PROFILER = Profiler(name)
+    return PROFILER
+
+@contextmanager
+def span(name, **attrs):
+    '''
+    Record a span if profiling is started
+    '''
+    if PROFILER is None:
+        yield None
+    else:
+        with PROFILER.span(name, **attrs) as s:
+            yield s
+
+def add_bytes(count):
+    '''
+    Add bytes moved to the current span if profiling is started
+    '''
+    if PROFILER is not None:
+        PROFILER.add_bytes(count)
+
+def bind(func):
+    '''
+    Return func recording its spans under the current span when it is called
+    from another thread
+    '''
+    if PROFILER is None:
+        return func
+    parent = PROFILER.stack[-1]
+    def wrapper(*args, **kwargs):
+        PROFILER.local.stack = [parent]
+        return func(*args, **kwargs)
+    return wrapper
+
+def wait(process, name, start=None):
+    '''
+    Wait a subprocess.Popen object and return its exit code
+    When profiling, its cpu time is recorded in a span named name
+    '''
+    if PROFILER is None or process.returncode is not None:
+        return process.wait()
+    pid, status, rusage = wait4(process.pid, 0)
+    process._handle_exitstatus(status)
+    PROFILER.add_process(name, start or PROFILER.t0, rusage)
+    return process.returncode
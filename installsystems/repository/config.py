@@ -36,7 +36,8 @@ class RepositoryConfig(object):
     def __init__(self, name, **kwargs):
         # set default value for arguments
         self._valid_param = ("name", "path", "dbpath", "lastpath",
-                             "uid", "gid", "fmod", "dmod", "offline")
+                             "catalogpath", "uid", "gid", "fmod", "dmod",
+                             "offline")
         self.name = Repository.check_name(name)
         self.path = ""
         self._offline = False
@@ -44,6 +45,10 @@ class RepositoryConfig(object):
         self.dbname = "db"
         self._lastpath = None
         self.lastname = "last"
+        self._catalogpath = None
+        self.catalogname = "catalog"
+        self.lockname = "lock"
+        self.scrubname = "scrub"
         self._uid = getuid()
         self._gid = getgid()
         oldmask = umask(0)
@@ -96,6 +101,57 @@ class RepositoryConfig(object):
         '''
         self._lastpath = value
 
+    @property
+    def catalogpath(self):
+        '''
+        Return the catalog file complete path
+        '''
+        if self._catalogpath is None:
+            return join(self.path, self.catalogname)
+        return self._catalogpath
+
+    @catalogpath.setter
+    def catalogpath(self, value):
+        '''
+        Set catalog path
+        '''
+        self._catalogpath = value
+
+    @property
+    def lockpath(self):
+        '''
+        Return the lock file complete path
+        '''
+        return join(self.path, self.lockname)
+
+    @property
+    def scrubpath(self):
+        '''
+        Return the scrub database complete path
+        '''
+        return join(self.path, self.scrubname)
+
+    @property
+    def workpath(self):
+        '''
+        Return the complete path of the database working copy
+        '''
+        return u"%s.work" % self.dbpath
+
+    @property
+    def metanames(self):
+        '''
+        Return the set of file names inside repository path which are not
+        part of the pool
+        '''
+        names = set((self.lockname, self.scrubname,
+                     u"%s-journal" % self.scrubname))
+        for name in (self.dbname, self.lastname, self.catalogname):
+            names |= set((name, u"%s.tmp" % name))
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            names.add(u"%s.work%s" % (self.dbname, suffix))
+        return names
+
     @property
     def dbpath(self):
         '''
@@ -20,11 +20,15 @@
 Database stuff
 '''
 
+import json
 import math
 import os
+import shutil
 import sqlite3
 import uuid
+import zlib
 import installsystems.tools as istools
+from contextlib import contextmanager
 from installsystems.exception import *
 from installsystems.printer import *
 
@@ -34,7 +38,7 @@ class Database(object):
     It needs to be local cause of sqlite3 which need to open a file
     '''
 
-    version = 2.0
+    version = 2.2
 
     @classmethod
     def create(cls, path):
@@ -49,7 +53,7 @@ class Database(object):
             conn = sqlite3.connect(path, isolation_level=None)
             conn.execute("PRAGMA foreign_keys = ON")
             conn.executescript(TEMPLATE_EMPTY_DB)
-            conn.execute("INSERT INTO repository values (?,?,?)",
+            conn.execute("INSERT INTO repository (uuid, version, motd) values (?,?,?)",
                          (str(uuid.uuid4()), Database.version, "",))
             conn.commit()
             conn.close()
@@ -57,6 +61,56 @@ class Database(object):
             raise ISError(u"Create database failed", e)
         return cls(path)
 
+    @classmethod
+    def load_catalog(cls, fileobj, path, last=None):
+        '''
+        Create a database in path from a catalog read in fileobj
+        When last is set, the catalog must have been dumped with the same last
+        value, otherwise it is outdated
+        '''
+        # check locality
+        if not istools.isfile(path):
+            raise ISError("Database creation must be local")
+        path = os.path.abspath(path)
+        if os.path.exists(path):
+            raise ISError("Database already exists. Remove it before")
+        try:
+            lines = _catalog_lines(fileobj)
+            header = json.loads(next(lines))
+            if header.get("catalog") != CATALOG_FORMAT:
+                raise ISError(u"Invalid catalog format %s" % header.get("catalog"))
+            if last is not None and header.get("last") != last:
+                raise ISError(u"Outdated catalog (%s)" % header.get("last"))
+            conn = sqlite3.connect(path, isolation_level=None)
+            conn.executescript(TEMPLATE_EMPTY_DB)
+            # build insert query of each table from columns given by the
+            # catalog, which must exist in the local database
+            known = [ r[0] for r in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'") ]
+            sql = {}
+            for table, columns in header["tables"].items():
+                if table not in known:
+                    raise ISError(u"Unknown catalog table %s" % table)
+                lcolumns = [ c[1] for c in
+                             conn.execute(u"PRAGMA table_info(%s)" % table) ]
+                for column in columns:
+                    if column not in lcolumns:
+                        raise ISError(u"Unknown catalog column %s.%s" %
+                                      (table, column))
+                sql[table] = u"INSERT INTO %s (%s) VALUES (%s)" % (
+                    table, ",".join(columns), ",".join("?" * len(columns)))
+            conn.execute("BEGIN TRANSACTION")
+            for line in lines:
+                row = json.loads(line)
+                conn.execute(sql[row[0]], row[1:])
+            conn.execute("COMMIT TRANSACTION")
+            conn.close()
+        except Exception as e:
+            if os.path.exists(path):
+                os.unlink(path)
+            raise ISError(u"Load catalog failed", e)
+        return cls(path)
+
     def __init__(self, path):
         # check locality
         if not istools.isfile(path):
@@ -74,6 +128,17 @@ class Database(object):
             self.version = float(r[0])
         except:
             self.version = 1.0
+        # sharded repositories are stored with a major version above their
+        # schema version, so older installsystems refuse them
+        self.sharded = False
+        if math.floor(self.version) == math.floor(Database.version) + SHARDED_VERSION:
+            try:
+                r = self.ask("SELECT layout FROM repository").fetchone()
+                self.sharded = r is not None and r[0] == "sharded"
+            except sqlite3.Error:
+                pass
+            if self.sharded:
+                self.version -= SHARDED_VERSION
         if math.floor(self.version) >= math.floor(Database.version) + 1.0:
             raise ISWarning(u"New database format (%s), please upgrade "
                             "your Installsystems version" % self.version)
@@ -84,6 +149,83 @@ class Database(object):
             debug(u"Invalid database format: %s" % self.version)
             raise ISError("Invalid database format")
 
+    def close(self):
+        '''
+        Close the database connection
+        '''
+        self.conn.close()
+
+    def checkout(self, path):
+        '''
+        Return a private working copy of the database, in WAL mode, at path
+        '''
+        try:
+            for f in (path, u"%s-wal" % path, u"%s-shm" % path):
+                if os.path.exists(f):
+                    os.unlink(f)
+            shutil.copyfile(self.path, path)
+            db = Database(path)
+            db.ask("PRAGMA journal_mode=WAL")
+        except Exception as e:
+            raise ISError(u"Unable to create database working copy", e)
+        return db
+
+    def publish(self, path):
+        '''
+        Atomically replace path by a snapshot of the database
+        Readers of path see either the old or the new snapshot
+        '''
+        tmppath = u"%s.tmp" % path
+        try:
+            # move all committed transactions into the database file
+            self.ask("PRAGMA wal_checkpoint(FULL)")
+            shutil.copyfile(self.path, tmppath)
+            # snapshot must be readable without write access to its directory
+            conn = sqlite3.connect(tmppath, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=DELETE")
+            conn.close()
+            fd = os.open(tmppath, os.O_RDONLY)
+            os.fsync(fd)
+            os.close(fd)
+            os.rename(tmppath, path)
+        except Exception as e:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            raise ISError(u"Unable to publish database", e)
+
+    def upgrade(self):
+        '''
+        Upgrade database schema to the current version
+        '''
+        if self.version < 2.0:
+            raise ISError(u"Unable to upgrade database version %s" % self.version)
+        for version, queries in TEMPLATE_UPGRADE_DB:
+            if self.version >= version:
+                continue
+            arrow(u"Upgrading database to version %s" % version)
+            self.begin()
+            for sql in queries:
+                self.ask(sql)
+            self.ask("UPDATE repository SET version = ?",
+                     (self.stored_version(version, self.sharded),))
+            self.commit()
+            self.version = version
+
+    @staticmethod
+    def stored_version(version, sharded):
+        '''
+        Return the version stored in the database of a schema version
+        '''
+        return version + SHARDED_VERSION if sharded else version
+
+    def set_layout(self, layout):
+        '''
+        Set the layout of the pool (flat or sharded)
+        '''
+        self.sharded = layout == "sharded"
+        self.ask("UPDATE repository SET layout = ?, version = ?",
+                 (layout, self.stored_version(self.version, self.sharded)))
+
     def begin(self):
         '''
         Start a db transaction
@@ -103,6 +245,110 @@ class Database(object):
         '''
         return self.conn.execute(sql, args)
 
+    @contextmanager
+    def attach(self, other, name="other"):
+        '''
+        Attach database other as name in this connection
+        '''
+        try:
+            self.ask(u"ATTACH DATABASE ? AS %s" % name, (other.path,))
+        except Exception as e:
+            raise ISError(u"Unable to attach database %s" % other.path, e)
+        try:
+            yield
+        finally:
+            self.ask(u"DETACH DATABASE %s" % name)
+
+    def _stream(self, sql):
+        '''
+        Yield rows of query sql, cursor is closed even if iteration is stopped
+        '''
+        cursor = self.ask(sql)
+        try:
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+
+    def diff(self, other):
+        '''
+        Yield images and payloads of this database which are not in database other
+        Rows are (table, md5, name, version), version is None for payloads.
+        Databases are attached, so the diff is computed and streamed by sqlite.
+        '''
+        with self.attach(other):
+            for row in self._stream(DIFF_IMAGE):
+                yield ("image",) + tuple(row)
+            for row in self._stream(DIFF_PAYLOAD):
+                yield ("payload",) + tuple(row) + (None,)
+
+    def dump_catalog(self, path, last=None):
+        '''
+        Dump tables needed by remote clients in a catalog file
+        A catalog is a gzip compressed file of sorted JSON lines. The first line
+        is a header which describes table columns and holds the last value of
+        the repository, others are table rows
+        '''
+        tmppath = u"%s.tmp" % path
+        try:
+            tables = {}
+            for table, order in CATALOG_TABLES:
+                tables[table] = [ c[1] for c in
+                                  self.ask(u"PRAGMA table_info(%s)" % table) ]
+            fo = open(tmppath, "wb")
+            zco = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            fo.write(zco.compress(json.dumps({"catalog": CATALOG_FORMAT,
+                                              "last": last,
+                                              "tables": tables}) + "\n"))
+            for table, order in CATALOG_TABLES:
+                for row in self.ask(u"SELECT %s FROM %s ORDER BY %s" %
+                                    (",".join(tables[table]), table, order)):
+                    fo.write(zco.compress(json.dumps([table] + list(row)) + "\n"))
+            fo.write(zco.flush())
+            fo.close()
+            os.rename(tmppath, path)
+        except Exception as e:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            raise ISError(u"Dump catalog failed", e)
+
+
+def _catalog_lines(fileobj):
+    '''
+    Generator of uncompressed lines of a catalog file object
+    '''
+    dco = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    buf = ""
+    while True:
+        data = fileobj.read(1048576) # 1MiB
+        if len(data) == 0:
+            break
+        lines = (buf + dco.decompress(data)).split("\n")
+        buf = lines.pop()
+        for line in lines:
+            yield line
+    buf += dco.flush()
+    if len(buf) > 0:
+        yield buf
+
+
+# images of main database not in other database
+DIFF_IMAGE = u"""SELECT md5, name, version FROM main.image WHERE md5 IN
+(SELECT md5 FROM main.image EXCEPT SELECT md5 FROM other.image)
+ORDER BY name, version"""
+
+# payloads of main database not in other database
+DIFF_PAYLOAD = u"""SELECT md5, MIN(name) FROM main.payload WHERE md5 IN
+(SELECT md5 FROM main.payload EXCEPT SELECT md5 FROM other.payload)
+GROUP BY md5 ORDER BY md5"""
+
+# catalog format version
+CATALOG_FORMAT = 1
+
+# tables exported in catalogs and their sort order
+CATALOG_TABLES = (("repository", "uuid"),
+                  ("image", "md5"),
+                  ("payload", "md5, image_md5"))
 
 TEMPLATE_EMPTY_DB = u"""
 CREATE TABLE image (md5 TEXT NOT NULL PRIMARY KEY,
@@ -125,5 +371,22 @@ CREATE TABLE payload (md5 TEXT NOT NULL,
 
 CREATE TABLE repository (uuid TEXT NOT NULL PRIMARY KEY,
                          version FLOAT NOT NULL,
-                         motd TEXT NOT NULL);
+                         motd TEXT NOT NULL,
+                         layout TEXT NOT NULL DEFAULT 'flat');
+
+CREATE TABLE refcount (md5 TEXT NOT NULL PRIMARY KEY,
+                       refs INTEGER NOT NULL,
+                       released INTEGER);
 """
+
+# major version added to the stored version of sharded repositories
+SHARDED_VERSION = 1.0
+
+# schema changes from previous database versions
+TEMPLATE_UPGRADE_DB = (
+    (2.1, ("ALTER TABLE repository ADD COLUMN layout TEXT NOT NULL DEFAULT 'flat'",)),
+    (2.2, ("CREATE TABLE refcount (md5 TEXT NOT NULL PRIMARY KEY, "
+           "refs INTEGER NOT NULL, released INTEGER)",
+           "INSERT INTO refcount (md5, refs) SELECT md5, COUNT(*) FROM "
+           "(SELECT md5 FROM image UNION ALL SELECT md5 FROM payload) GROUP BY md5")),
+)
@@ -22,6 +22,7 @@ Repository management module
 
 from installsystems.exception import ISError, ISWarning
 from installsystems.printer import out, debug, arrow
+from installsystems.repository.database import Database
 from installsystems.repository.factory import RepositoryFactory
 from installsystems.repository.repository import Repository
 from installsystems.tools import isfile, chrights, PipeFile, compare_versions
@@ -155,18 +156,28 @@ class RepositoryManager(object):
             else:
                 config.dbpath = join(self.cache_path, config.name)
             if not nosync:
-                # Open remote database
-                rdb = PipeFile(original_dbpath, timeout=self.timeout)
+                # get remote last value. The last file is updated by every
+                # installsystems version, unlike the catalog
+                try:
+                    last = int(PipeFile(config.lastpath, mode='r',
+                                        timeout=self.timeout).read().strip())
+                except ISError:
+                    last = None
+                # Open remote catalog, fallback on remote database
+                try:
+                    rdb = PipeFile(config.catalogpath, timeout=self.timeout)
+                    catalog = True
+                except ISError:
+                    rdb = PipeFile(original_dbpath, timeout=self.timeout)
+                    catalog = False
                 # get remote last modification
-                if rdb.mtime is None:
-                    # We doesn't have modification time, we use the last file
-                    try:
-                        rlast = int(PipeFile(config.lastpath, mode='r',
-                                             timeout=self.timeout).read().strip())
-                    except ISError:
-                        rlast = -1
-                else:
+                if last is not None:
+                    rlast = last
+                elif rdb.mtime is not None:
+                    # We doesn't have last file, we use the modification time
                     rlast = rdb.mtime
+                else:
+                    rlast = -1
                 # get local last value
                 if exists(config.dbpath):
                     llast = int(stat(config.dbpath).st_mtime)
@@ -175,11 +186,27 @@ class RepositoryManager(object):
                 # if repo is out of date, download it
                 if rlast != llast:
                     try:
-                        arrow(u"Downloading %s" % original_dbpath)
-                        rdb.progressbar = True
-                        ldb = open(config.dbpath, "wb")
-                        rdb.consume(ldb)
-                        ldb.close()
+                        if exists(config.dbpath):
+                            unlink(config.dbpath)
+                        if catalog:
+                            arrow(u"Downloading %s" % config.catalogpath)
+                            rdb.progressbar = True
+                            try:
+                                Database.load_catalog(rdb, config.dbpath, last)
+                            except ISError as e:
+                                # catalog is not updated by older versions
+                                debug(u"Unable to load catalog of %s: %s" %
+                                      (config.name, e))
+                                rdb.close()
+                                rdb = PipeFile(original_dbpath,
+                                               timeout=self.timeout)
+                                catalog = False
+                        if not catalog:
+                            arrow(u"Downloading %s" % original_dbpath)
+                            rdb.progressbar = True
+                            ldb = open(config.dbpath, "wb")
+                            rdb.consume(ldb)
+                            ldb.close()
                         rdb.close()
                         chrights(config.dbpath,
                                          uid=config.uid,
@@ -20,18 +20,35 @@
 Abstract repository module
 '''
 
-from cStringIO import StringIO
+from argparse import Namespace
+from contextlib import contextmanager
+from errno import ENOENT
+from fcntl import flock, LOCK_EX, LOCK_NB
+from functools import partial
+from json import dumps
 from installsystems.exception import ISError
 from installsystems.image.package import PackageImage
 from installsystems.printer import arrow, arrowlevel, out, warn, confirm
 from installsystems.repository.database import Database
+from installsystems.repository.scrub import Scrubber
 from installsystems.tools import isfile, chrights, mkdir, compare_versions, PipeFile
-from os import unlink, listdir, linesep, rmdir
+from installsystems.tools import parallel_imap, human_size, scandir
+from os import unlink, rmdir, rename
+from os import link
 from os.path import join
-from os.path import join, basename, exists, isdir
-from re import match, split
+from os.path import join, basename, exists, isdir, abspath, dirname
+from re import match, split, compile
 from time import time
 
+# name of directories of a sharded pool
+SHARD_PATTERN = compile("^[0-9a-f]{2}$")
+
+# name of files of the pool
+MD5_PATTERN = compile("^[0-9a-f]{32}$")
+
+# available layouts of the pool
+LAYOUTS = ("flat", "sharded")
+
 class Repository(object):
     '''
     Repository class
@@ -72,40 +89,27 @@ class Repository(object):
         return [r for r in  split("[ ,\n\t\v]+", repolist) if filter(r)]
 
     @staticmethod
-    def diff(repo1, repo2):
+    def diff(repo1, repo2, o_json=False):
         '''
         Compute a diff between two repositories
         '''
-        arrow(u"Diff between repositories #y#%s#R# and #g#%s#R#" % (repo1.config.name,
-                                                                    repo2.config.name))
-        # Get info from databases
-        i_dict1 = dict((b[0], b[1:]) for b in repo1.db.ask(
-            "SELECT md5, name, version FROM image").fetchall())
-        i_set1 = set(i_dict1.keys())
-        i_dict2 = dict((b[0], b[1:]) for b in repo2.db.ask(
-            "SELECT md5, name, version FROM image").fetchall())
-        i_set2 = set(i_dict2.keys())
-        p_dict1 = dict((b[0], b[1:]) for b in  repo1.db.ask(
-            "SELECT md5, name FROM payload").fetchall())
-        p_set1 = set(p_dict1.keys())
-        p_dict2 = dict((b[0], b[1:]) for b in repo2.db.ask(
-            "SELECT md5, name FROM payload").fetchall())
-        p_set2 = set(p_dict2.keys())
-        # computing diff
-        i_only1 = i_set1 - i_set2
-        i_only2 = i_set2 - i_set1
-        p_only1 = p_set1 - p_set2
-        p_only2 = p_set2 - p_set1
-        # printing functions
-        pimg = lambda r,c,m,d,: out("#%s#Image only in repository %s: %s v%s (%s)#R#" %
-                                    (c, r.config.name, d[m][0], d[m][1], m))
-        ppay = lambda r,c,m,d,: out("#%s#Payload only in repository %s: %s (%s)#R#" %
-                                    (c, r.config.name, d[m][0], m))
-        # printing image diff
-        for md5 in i_only1: pimg(repo1, "y", md5, i_dict1)
-        for md5 in p_only1: ppay(repo1, "y", md5, p_dict1)
-        for md5 in i_only2: pimg(repo2, "g", md5, i_dict2)
-        for md5 in p_only2: ppay(repo2, "g", md5, p_dict2)
+        if not o_json:
+            arrow(u"Diff between repositories #y#%s#R# and #g#%s#R#" % (repo1.config.name,
+                                                                        repo2.config.name))
+        l = []
+        for r1, r2, c in ((repo1, repo2, "y"), (repo2, repo1, "g")):
+            for table, md5, name, version in r1.db.diff(r2.db):
+                if o_json:
+                    l.append({"repository": r1.config.name, "type": table,
+                              "md5": md5, "name": name, "version": version})
+                elif table == "image":
+                    out(u"#%s#Image only in repository %s: %s v%s (%s)#R#" %
+                        (c, r1.config.name, name, version, md5))
+                else:
+                    out(u"#%s#Payload only in repository %s: %s (%s)#R#" %
+                        (c, r1.config.name, name, md5))
+        if o_json:
+            out(dumps(l))
 
     def __init__(self, config, db=None):
         self.config = config
@@ -119,8 +123,8 @@ class Repository(object):
         because repository is not initialized
         '''
         config = object.__getattribute__(self, "config")
-        # config, init, local and upgrade are always accessible
-        if name in ("init", "config", "local", "upgrade"):
+        # config, init, local, lock and upgrade are always accessible
+        if name in ("init", "config", "local", "lock", "upgrade"):
             return object.__getattribute__(self, name)
         # if no db (not init or not accessible) raise error
         if config.offline:
@@ -141,6 +145,66 @@ class Repository(object):
         '''
         return self.db.ask("SELECT uuid from repository").fetchone()[0]
 
+    @property
+    def layout(self):
+        '''
+        Return layout of the pool (flat or sharded)
+        '''
+        if self.db.version < 2.1:
+            return "flat"
+        return self.db.ask("SELECT layout FROM repository").fetchone()[0]
+
+    def objpath(self, md5, layout=None):
+        '''
+        Return path of a file of the pool from its md5
+        Sharded layout store files in two levels of directories (ab/cd/abcd...)
+        '''
+        if layout is None:
+            layout = self.layout
+        if layout == "sharded":
+            return join(self.config.path, md5[:2], md5[2:4], md5)
+        return join(self.config.path, md5)
+
+    def _walk_pool(self):
+        '''
+        Yield name and path of each file of the pool, whatever the layout
+        '''
+        metanames = self.config.metanames
+        for name, path, is_dir in scandir(self.config.path):
+            if name in metanames:
+                continue
+            if is_dir and SHARD_PATTERN.match(name):
+                for sname, spath, sis_dir in scandir(path):
+                    if sis_dir and SHARD_PATTERN.match(sname):
+                        for fname, fpath, fis_dir in scandir(spath):
+                            yield fname, fpath
+                    else:
+                        yield sname, spath
+            else:
+                yield name, path
+
+    def _mkshard(self, md5, layout):
+        '''
+        Create directories of the pool needed to store md5
+        '''
+        directory = dirname(self.objpath(md5, layout))
+        if not exists(directory):
+            mkdir(directory, self.config.uid, self.config.gid, self.config.dmod)
+
+    def _rmshard(self, path):
+        '''
+        Remove shard directories of the pool file path if they are empty
+        '''
+        for _ in range(2):
+            path = dirname(path)
+            if (path == abspath(self.config.path) or
+                SHARD_PATTERN.match(basename(path)) is None):
+                return
+            try:
+                rmdir(path)
+            except OSError:
+                return
+
     def init(self):
         '''
         Initialize an empty base repository
@@ -162,29 +226,91 @@ class Repository(object):
         except Exception as e:
             raise ISError(u"Unable to create directory %s" % config.path, e)
         arrowlevel(-1)
-        # create database
-        d = Database.create(config.dbpath)
-        chrights(config.dbpath, uid=config.uid,
-                         gid=config.gid, mode=config.fmod)
-        # load database
-        self.db = Database(config.dbpath)
-        # mark repo as not offline
-        self.config.offline = False
-        # create/update last file
-        self.update_last()
+        with self.lock():
+            if exists(config.dbpath):
+                raise ISError("Database already exists. Remove it before")
+            # create database in the working copy
+            if exists(config.workpath):
+                unlink(config.workpath)
+            db = Database.create(config.workpath)
+            db.ask("PRAGMA journal_mode=WAL")
+            self.db = db
+            # mark repo as not offline
+            self.config.offline = False
+            # publish database and create/update last file
+            self.update_last()
+
+    @contextmanager
+    def lock(self):
+        '''
+        Serialize repository writers with a lock file
+        While the lock is held, database is a private working copy which is
+        published by update_last
+        '''
+        # check local repository
+        if not self.local:
+            raise ISError(u"Repository must be local")
+        try:
+            lockfo = open(self.config.lockpath, "a")
+        except IOError as e:
+            raise ISError(u"Unable to open lock file %s" % self.config.lockpath, e)
+        try:
+            try:
+                flock(lockfo, LOCK_EX | LOCK_NB)
+            except IOError:
+                arrow("Waiting for repository lock")
+                flock(lockfo, LOCK_EX)
+            # snapshot may have been published by another writer since loading
+            # db is read directly, lock must work on offline repository
+            snapshot = object.__getattribute__(self, "db")
+            if snapshot is not None:
+                self.db = Database(self.config.dbpath).checkout(self.config.workpath)
+            try:
+                yield
+            finally:
+                work = object.__getattribute__(self, "db")
+                if work is not snapshot:
+                    work.close()
+                    for suffix in ("", "-wal", "-shm"):
+                        path = u"%s%s" % (self.config.workpath, suffix)
+                        if exists(path):
+                            unlink(path)
+                if exists(self.config.dbpath):
+                    self.db = Database(self.config.dbpath)
+        finally:
+            # closing the lock file releases the lock
+            lockfo.close()
 
     def update_last(self):
         '''
-        Update last file to current time
+        Publish database snapshot, catalog and last file
+        Last file is updated last, because remote clients use it to know
+        when the database has changed. The catalog holds the same last value,
+        so clients detect catalogs left outdated by older installsystems
         '''
         # check local repository
         if not self.local:
             raise ISError(u"Repository must be local")
+        # publish database snapshot when working on a copy
+        if self.db.path != abspath(self.config.dbpath):
+            arrow("Publishing database")
+            self.db.publish(self.config.dbpath)
+            chrights(self.config.dbpath, self.config.uid, self.config.gid,
+                     self.config.fmod)
+        last = int(time())
+        # catalog needs the repository table of database v2
+        if self.db.version >= 2.0:
+            arrow("Updating catalog")
+            self.db.dump_catalog(self.config.catalogpath, last)
+            chrights(self.config.catalogpath, self.config.uid, self.config.gid,
+                     self.config.fmod)
         try:
             arrow("Updating last file")
             last_path = join(self.config.path, self.config.lastname)
-            open(last_path, "w").write("%s\n" % int(time()))
-            chrights(last_path, self.config.uid, self.config.gid, self.config.fmod)
+            open(u"%s.tmp" % last_path, "w").write("%s\n" % last)
+            chrights(u"%s.tmp" % last_path, self.config.uid, self.config.gid,
+                     self.config.fmod)
+            rename(u"%s.tmp" % last_path, last_path)
         except Exception as e:
             raise ISError(u"Update last file failed", e)
 
@@ -200,14 +326,28 @@ class Repository(object):
         # return last
         return reduce(f, r)
 
-    def _add(self, image):
+    def _add(self, *images):
         '''
-        Add description to db
+        Add description of images to db in one transaction
         '''
         arrow("Adding metadata")
         self.db.begin()
+        for image in images:
+            arrow(u"%s v%s" % (image.name, image.version), 1)
+            self._insert(image)
+        if self.db.version >= 2.2:
+            self._count_refs(set(obj.md5 for image in images
+                                 for obj in [ image ] + image.payload.values()))
+        # on commit
+        self.db.commit()
+        # update last file
+        self.update_last()
+
+    def _insert(self, image):
+        '''
+        Insert image and payloads description into db
+        '''
         # insert image information
-        arrow("Image", 1)
         self.db.ask("INSERT INTO image values (?,?,?,?,?,?,?,?,?)",
                     (image.md5,
                      image.name,
@@ -220,7 +360,6 @@ class Repository(object):
                      image.format,
                      ))
         # insert data information
-        arrow("Payloads", 1)
         for name, obj in image.payload.items():
             self.db.ask("INSERT INTO payload values (?,?,?,?,?)",
                         (obj.md5,
@@ -229,52 +368,206 @@ class Repository(object):
                          obj.isdir,
                          obj.size,
                          ))
-        # on commit
-        self.db.commit()
-        # update last file
-        self.update_last()
 
-    def add(self, image, delete=False):
+    def _count_refs(self, md5s, release=True):
+        '''
+        Update reference count of files md5s, inside the current transaction
+        Counting from image and payload tables keeps counts right when a writer
+        without reference counting has modified the database.
+        A file which is not referenced anymore is released, it will be removed
+        by gc, except if release is false.
+        Return the list of released md5
+        '''
+        now = int(time())
+        released = []
+        for md5 in md5s:
+            refs = 0
+            for table in ("image", "payload"):
+                refs += self.db.ask(u"SELECT COUNT(*) FROM %s WHERE md5 = ?" % table,
+                                    (md5,)).fetchone()[0]
+            if refs == 0 and release:
+                released.append(md5)
+            self.db.ask("INSERT OR REPLACE INTO refcount VALUES (?,?,?)",
+                        (md5, refs, now if refs == 0 and release else None))
+        return released
+
+    def _is_referenced(self, md5):
+        '''
+        Return true if md5 is referenced by an image or a payload
+        '''
+        for table in ("image", "payload"):
+            if self.db.ask(u"SELECT md5 FROM %s WHERE md5 = ? LIMIT 1" % table,
+                           (md5,)).fetchone() is not None:
+                return True
+        return False
+
+    def _is_known(self, md5):
+        '''
+        Return true if md5 is referenced or waiting in database to be removed
+        Files kept by a delete without release are unreferenced.
+        '''
+        if self.db.version >= 2.2:
+            if self.db.ask("SELECT md5 FROM refcount WHERE md5 = ? AND "
+                           "(refs > 0 OR released IS NOT NULL) LIMIT 1",
+                           (md5,)).fetchone() is not None:
+                return True
+        return self._is_referenced(md5)
+
+    def _copy_object(self, obj, layout, progressbar=False, paranoid=False):
+        '''
+        Copy an image or a payload into the pool and check it
+        Object is copied under a temporary name and moved when it's valid
+        md5 and size are computed while copying, if paranoid is true, the copy
+        is read back from disk and checked again
+        '''
+        dest = self.objpath(obj.md5, layout)
+        tmp = u"%s.tmp" % dest
+        try:
+            dfo = open(tmp, "wb")
+            sfo = PipeFile(obj.path, "r", progressbar=progressbar)
+            sfo.consume(dfo)
+            sfo.close()
+            dfo.close()
+            fos = [ sfo ]
+            if paranoid:
+                cfo = PipeFile(tmp, "r")
+                cfo.consume()
+                cfo.close()
+                fos.append(cfo)
+            # checking must be done with original md5
+            for fo in fos:
+                if fo.read_size != obj.size:
+                    raise ISError(u"Invalid size of %s" % basename(obj.path))
+                if fo.md5 != obj.md5:
+                    raise ISError(u"Invalid MD5 of %s" % basename(obj.path))
+            chrights(tmp, self.config.uid, self.config.gid, self.config.fmod)
+            rename(tmp, dest)
+        except:
+            if exists(tmp):
+                unlink(tmp)
+            raise
+        return obj
+
+    def add(self, image, delete=False, paranoid=False):
         '''
         Add a packaged image to repository
         if delete is true, remove original files
+        if paranoid is true, files are read back from pool to be checked
+        '''
+        self.add_batch([image], delete=delete, paranoid=paranoid)
+
+    def add_batch(self, images, delete=False, jobs=None, paranoid=False):
+        '''
+        Add packaged images to repository
+        Images and payloads are copied by jobs parallel workers. An object shared
+        by several images is copied and checked once. Metadata of all images are
+        committed in one transaction.
+        if delete is true, remove original files
+        if paranoid is true, files are read back from pool to be checked
         '''
         # check local repository
         if not self.local:
             raise ISError(u"Repository addition must be local")
-        # cannot add already existant image
-        if self.has(image.name, image.version):
-            raise ISError(u"Image already in database, delete first!")
-        # adding file to repository
-        arrow("Copying images and payload")
-        for obj in [ image ] + image.payload.values():
-            dest = join(self.config.path, obj.md5)
-            basesrc = basename(obj.path)
-            if exists(dest):
-                arrow(u"Skipping %s: already exists" % basesrc, 1)
-            else:
-                arrow(u"Adding %s (%s)" % (basesrc, obj.md5), 1)
-                dfo = open(dest, "wb")
-                sfo = PipeFile(obj.path, "r", progressbar=True)
-                sfo.consume(dfo)
-                sfo.close()
-                dfo.close()
-                chrights(dest, self.config.uid,
-                                 self.config.gid, self.config.fmod)
-        # copy is done. create a image inside repo
-        r_image = PackageImage(join(self.config.path, image.md5),
-                               md5name=True)
-        # checking must be done with original md5
-        r_image.md5 = image.md5
-        # checking image and payload after copy
-        r_image.check("Check image and payload")
-        self._add(image)
+        # cannot add twice the same image
+        names = set()
+        for image in images:
+            if (image.name, image.version) in names:
+                raise ISError(u"Image %s v%s is given twice" %
+                              (image.name, image.version))
+            names.add((image.name, image.version))
+        with self.lock():
+            # cannot add already existant image
+            for image in images:
+                if self.has(image.name, image.version):
+                    raise ISError(u"Image %s v%s already in database, delete first!"
+                                  % (image.name, image.version))
+            # deduplicate objects by md5
+            objects = {}
+            for image in images:
+                for obj in [ image ] + image.payload.values():
+                    objects.setdefault(obj.md5, obj)
+            # adding file to repository
+            arrow("Copying images and payload")
+            arrowlevel(1)
+            layout = self.layout
+            copies = []
+            for md5, obj in sorted(objects.items()):
+                if exists(self.objpath(md5, layout)):
+                    arrow(u"Skipping %s: already exists" % basename(obj.path))
+                else:
+                    self._mkshard(md5, layout)
+                    copies.append(obj)
+            # progress bars of parallel copies would overlap
+            copy = partial(self._copy_object, layout=layout,
+                           progressbar=len(copies) == 1, paranoid=paranoid)
+            for obj in parallel_imap(copy, copies, jobs):
+                arrow(u"Added %s (%s)" % (basename(obj.path), obj.md5))
+            arrowlevel(-1)
+            self._add(*images)
         # removing orginal files
         if delete:
             arrow("Removing original files")
+            for image in images:
+                for obj in [ image ] + image.payload.values():
+                    arrow(basename(obj.path), 1)
+                    unlink(obj.path)
+
+    def _sync_plan(self, src):
+        '''
+        Return images of repository src missing in this repository
+        Images are given with their payloads in the format expected by add_batch
+        '''
+        payloads = {}
+        srclayout = src.layout
+        for md5, image_md5, name, isdir, size in src.db.ask(
+            "SELECT md5, image_md5, name, isdir, size FROM payload"):
+            payloads.setdefault(image_md5, {})[name] = Namespace(
+                md5=md5, isdir=isdir, size=size, path=src.objpath(md5, srclayout))
+        images = []
+        for desc in src.images():
+            r = self.db.ask("SELECT md5 FROM image WHERE name = ? AND version = ?",
+                            (desc["name"], desc["version"])).fetchone()
+            if r is not None:
+                if r[0] != desc["md5"]:
+                    warn(u"Image %s v%s differs between repositories, skipped" %
+                         (desc["name"], desc["version"]))
+                continue
+            image = Namespace(path=desc["url"], payload=payloads.get(desc["md5"], {}),
+                              **desc)
+            images.append(image)
+        return images
+
+    def sync(self, src, dry_run=False, jobs=None, paranoid=False):
+        '''
+        Copy images of repository src which are missing in this repository
+        Only files missing in the pool are transferred, by jobs parallel workers,
+        and metadata of all images are committed in one transaction.
+        An interrupted sync can be run again, files already copied are kept.
+        if dry_run is true, only show what would be copied
+        '''
+        # check local repository
+        if not self.local:
+            raise ISError(u"Repository synchronization must be local")
+        arrow(u"Synchronizing repository %s from %s" % (self.config.name,
+                                                       src.config.name))
+        images = self._sync_plan(src)
+        # compute files to transfer
+        layout = self.layout
+        objects = {}
+        for image in images:
             for obj in [ image ] + image.payload.values():
-                arrow(basename(obj.path), 1)
-                unlink(obj.path)
+                if not exists(self.objpath(obj.md5, layout)):
+                    objects[obj.md5] = obj
+        arrow(u"%d images to copy, %d files to transfer (%s)" % (
+            len(images), len(objects),
+            human_size(sum(obj.size for obj in objects.values()))), 1)
+        if dry_run:
+            for image in images:
+                out(u"%s v%s (%s)" % (image.name, image.version, image.md5))
+            return
+        if len(images) == 0:
+            return
+        self.add_batch(images, jobs=jobs, paranoid=paranoid)
 
     def getallmd5(self):
         '''
@@ -283,35 +576,66 @@ class Repository(object):
         res = self.db.ask("SELECT md5 FROM image UNION SELECT md5 FROM payload").fetchall()
         return [ md5[0] for md5 in res ]
 
-    def check(self):
+    def check(self, jobs=None, max_age=None, time_budget=None, io_budget=None,
+              o_json=False):
         '''
-        Check repository for unreferenced and missing files
+        Check repository for unreferenced, missing and corrupted files
+        Files are hashed by jobs processes. All files are checked, unless
+        max_age is set: unmodified files checked less than max_age seconds ago
+        are skipped. time_budget (in seconds) and io_budget
+        (in bytes) bound the hashing work of a run.
+        if o_json is true, results are printed as json lines
         '''
         # Check if the repo is local
         if not self.local:
             raise ISError(u"Repository must be local")
-        local_files = set(listdir(self.config.path))
-        local_files.remove(self.config.dbname)
-        local_files.remove(self.config.lastname)
+        if o_json:
+            report = lambda event, **kwargs: out(dumps(dict(event=event, **kwargs)))
+            step = lambda message: None
+        else:
+            report = lambda event, md5=None, **kwargs: out(md5)
+            step = arrow
+        local_paths = dict(self._walk_pool())
+        local_files = set(local_paths)
         db_files = set(self.getallmd5())
         # check missing files
-        arrow("Checking missing files")
-        missing_files = db_files - local_files
-        if len(missing_files) > 0:
-            out(linesep.join(missing_files))
+        step("Checking missing files")
+        for md5 in sorted(db_files - local_files):
+            report("missing", md5=md5)
         # check unreferenced files
-        arrow("Checking unreferenced files")
-        unref_files = local_files - db_files
-        if len(unref_files) > 0:
-            out(linesep.join(unref_files))
+        step("Checking unreferenced files")
+        for md5 in sorted(local_files - db_files):
+            report("unreferenced", md5=md5)
         # check corruption of local files
-        arrow("Checking corrupted files")
-        for f in local_files:
-            fo = PipeFile(join(self.config.path, f))
-            fo.consume()
-            fo.close()
-            if fo.md5 != f:
-                out(f)
+        step("Checking corrupted files")
+        start = time()
+        scrubber = Scrubber(self.config.scrubpath)
+        try:
+            scrubber.forget(local_files)
+            todo, uptodate = scrubber.plan(local_paths, max_age=max_age,
+                                           io_budget=io_budget)
+            checked = size = 0
+            corrupted = []
+            for md5, fsize, status in scrubber.scrub(todo, jobs=jobs,
+                                                      time_budget=time_budget):
+                checked += 1
+                size += fsize
+                if status != "ok":
+                    corrupted.append(md5)
+                    report(status, md5=md5)
+                elif o_json:
+                    report(status, md5=md5, size=fsize)
+        finally:
+            scrubber.close()
+        summary = dict(checked=checked, size=size, uptodate=uptodate,
+                       remaining=len(local_files) - uptodate - checked,
+                       corrupted=len(corrupted),
+                       elapsed=round(time() - start, 3))
+        if o_json:
+            report("summary", **summary)
+        else:
+            arrow(u"%d files checked (%s), %d up to date, %d remaining" %
+                  (checked, human_size(size), uptodate, summary["remaining"]), 1)
 
     def clean(self, force=False):
         '''
@@ -320,32 +644,129 @@ class Repository(object):
         # Check if the repo is local
         if not self.local:
             raise ISError(u"Repository must be local")
-        allmd5 = set(self.getallmd5())
-        repofiles = set(listdir(self.config.path)) - set([self.config.dbname, self.config.lastname])
-        dirtyfiles = repofiles - allmd5
+        # files released by delete are removed by gc
+        dirtyfiles = [ (f, p) for f, p in self._walk_pool()
+                       if not self._is_known(f) ]
         if len(dirtyfiles) > 0:
             # print dirty files
             arrow("Dirty files:")
-            for f in dirtyfiles:
+            for f, p in dirtyfiles:
                 arrow(f, 1)
             # ask confirmation
             if not force and not confirm("Remove dirty files? (yes) "):
                 raise ISError(u"Aborted!")
             # start cleaning
             arrow("Cleaning")
-            for f in dirtyfiles:
-                p = join(self.config.path, f)
-                arrow(u"Removing %s" % p, 1)
-                try:
-                    if isdir(p):
-                        rmdir(p)
-                    else:
-                        unlink(p)
-                except:
-                    warn(u"Removing %s failed" % p)
+            # lock is held by writers until their files are in database
+            with self.lock():
+                forgotten = 0
+                for f, p in dirtyfiles:
+                    if self._is_known(f):
+                        continue
+                    arrow(u"Removing %s" % p, 1)
+                    try:
+                        if isdir(p):
+                            rmdir(p)
+                        else:
+                            unlink(p)
+                            self._rmshard(p)
+                    except:
+                        warn(u"Removing %s failed" % p)
+                        continue
+                    # forget counts of files kept by a delete without release
+                    if self.db.version >= 2.2:
+                        forgotten += self.db.ask(
+                            "DELETE FROM refcount WHERE md5 = ? AND "
+                            "refs = 0 AND released IS NULL", (f,)).rowcount
+                if forgotten > 0:
+                    self.update_last()
         else:
             arrow("Nothing to clean")
 
+    def gc(self, grace=3600, batch=1000):
+        '''
+        Remove files of the pool released for more than grace seconds
+        Files are removed by batches of batch files. Each batch holds the
+        repository lock, so writers can run between batches.
+        '''
+        # check local repository
+        if not self.local:
+            raise ISError(u"Repository must be local")
+        arrow("Removing released files")
+        arrowlevel(1)
+        removed = 0
+        while True:
+            with self.lock():
+                # reference counting is available since database version 2.2
+                self.db.upgrade()
+                md5s = [ r[0] for r in self.db.ask(
+                    "SELECT md5 FROM refcount WHERE refs = 0 AND released <= ? "
+                    "LIMIT ?", (int(time()) - grace, batch)) ]
+                if len(md5s) == 0:
+                    break
+                layout = self.layout
+                self.db.begin()
+                for md5 in md5s:
+                    # never trust a count of a file still referenced
+                    if self._is_referenced(md5):
+                        self._count_refs([md5])
+                        continue
+                    arrow(md5)
+                    path = self.objpath(md5, layout)
+                    try:
+                        unlink(path)
+                    except OSError as e:
+                        if e.errno != ENOENT:
+                            raise ISError(u"Unable to remove %s" % md5, e)
+                    self._rmshard(path)
+                    self.db.ask("DELETE FROM refcount WHERE md5 = ?", (md5,))
+                    removed += 1
+                self.db.commit()
+                self.update_last()
+        arrowlevel(-1)
+        arrow(u"%d files removed" % removed)
+
+    def relayout(self, layout):
+        '''
+        Move files of the pool to another layout
+        Files are linked at their new path before the database is published,
+        and removed from their old path after, so readers always find files.
+        '''
+        # check local repository
+        if not self.local:
+            raise ISError(u"Repository must be local")
+        if layout not in LAYOUTS:
+            raise ISError(u"Invalid layout %s" % layout)
+        with self.lock():
+            # layout is stored since database version 2.1
+            self.db.upgrade()
+            if self.layout == layout:
+                arrow(u"Repository already has %s layout" % layout)
+                return
+            arrow(u"Linking files in %s layout" % layout)
+            oldpaths = []
+            for name, path in list(self._walk_pool()):
+                if MD5_PATTERN.match(name) is None:
+                    continue
+                newpath = self.objpath(name, layout)
+                if newpath == path:
+                    continue
+                # file can be linked by a previous interrupted run
+                if not exists(newpath):
+                    self._mkshard(name, layout)
+                    link(path, newpath)
+                oldpaths.append(path)
+            arrow(u"%d files linked" % len(oldpaths), 1)
+            # sharded repositories raise the major version of the database,
+            # older installsystems would not find their files
+            self.db.set_layout(layout)
+            self.update_last()
+            arrow("Removing files from old layout")
+            for path in oldpaths:
+                unlink(path)
+                # remove empty shard directories
+                self._rmshard(path)
+
     def delete(self, name, version, payloads=True):
         '''
         Delete an image from repository
@@ -353,30 +774,41 @@ class Repository(object):
         # check local repository
         if not self.local:
             raise ISError(u"Repository deletion must be local")
-        # get md5 of files related to images (exception is raised if not exists
-        md5s = self.getmd5(name, version)
-        # cleaning db (must be done before cleaning)
-        arrow("Cleaning database")
-        arrow("Remove payloads from database", 1)
-        self.db.begin()
-        for md5 in md5s[1:]:
-            self.db.ask("DELETE FROM payload WHERE md5 = ? AND image_md5 = ?",
-                        (md5, md5s[0])).fetchone()
-        arrow("Remove image from database", 1)
-        self.db.ask("DELETE FROM image WHERE md5 = ?",
-                        (md5s[0],)).fetchone()
-        self.db.commit()
-        # Removing files
-        arrow("Removing files from pool")
-        # if asked don't remove payloads
-        if not payloads:
-            md5s = [ md5s[0] ]
-        arrowlevel(1)
-        for md5 in md5s:
-            self._remove_file(md5)
-        arrowlevel(-1)
-        # update last file
-        self.update_last()
+        with self.lock():
+            # get md5 of files related to images (exception is raised if not exists
+            md5s = self.getmd5(name, version)
+            # cleaning db (must be done before cleaning)
+            arrow("Cleaning database")
+            arrow("Remove payloads from database", 1)
+            self.db.begin()
+            for md5 in md5s[1:]:
+                self.db.ask("DELETE FROM payload WHERE md5 = ? AND image_md5 = ?",
+                            (md5, md5s[0])).fetchone()
+            arrow("Remove image from database", 1)
+            self.db.ask("DELETE FROM image WHERE md5 = ?",
+                            (md5s[0],)).fetchone()
+            if self.db.version >= 2.2:
+                # if asked don't release payloads
+                released = self._count_refs(md5s[:1])
+                released += self._count_refs(md5s[1:], release=payloads)
+            self.db.commit()
+            # publish before removing files, readers must never see an image
+            # which is not in the pool anymore
+            self.update_last()
+            # files are removed later by gc, readers of the previous database
+            # can still download them
+            if self.db.version >= 2.2:
+                arrow(u"%d files released, run gc to remove them" % len(released))
+                return
+            # Removing files
+            arrow("Removing files from pool")
+            # if asked don't remove payloads
+            if not payloads:
+                md5s = [ md5s[0] ]
+            arrowlevel(1)
+            for md5 in md5s:
+                self._remove_file(md5)
+            arrowlevel(-1)
 
     def images(self):
         '''
@@ -389,10 +821,11 @@ class Repository(object):
         images = []
         field = ("md5", "name", "version", "date", "author", "description",
                  "size", "is_min_version", "format")
+        layout = self.layout
         for info in db_images:
             d = dict(zip(field, info))
             d["repo"] = self.config.name
-            d["url"] = join(self.config.path, d["md5"])
+            d["url"] = self.objpath(d["md5"], layout)
             images.append(d)
         return images
 
@@ -435,15 +868,12 @@ class Repository(object):
         '''
         Remove a filename from pool. Check if it's not needed by db before
         '''
-        # check existance in table image
-        have = False
-        for table in ("image", "payload"):
-            have = have or  self.db.ask(u"SELECT md5 FROM %s WHERE md5 = ? LIMIT 1" % table,
-                                        (filename,)).fetchone() is not None
         # if no reference, delete!
-        if not have:
+        if not self._is_referenced(filename):
             arrow(u"%s, deleted" % filename)
-            unlink(join(self.config.path, filename))
+            path = self.objpath(filename)
+            unlink(path)
+            self._rmshard(path)
         else:
             arrow(u"%s, skipped" % filename)
 
@@ -457,35 +887,42 @@ class Repository(object):
         '''
         Return an image from a name and version
         '''
+        return self.opener(name, version)()
+
+    def opener(self, name, version=None):
+        '''
+        Return a function loading an image from a name and version
+        The database is only queried here, so the returned function can be
+        called from another thread
+        '''
         # is no version take the last
         if version is None:
             version = self.last(name)
             if version is None:
                 raise ISError(u"Unable to find image %s in %s" % (name,
                                                                       self.config.name))
-        # get file md5 from db
-        r = self.db.ask("select md5 from image where name = ? and version = ? limit 1",
+        # get file md5 and size from db
+        r = self.db.ask("select md5, size from image where name = ? and version = ? limit 1",
                         (name, version)).fetchone()
         if r is None:
             raise ISError(u"Unable to find image %s v%s in %s" % (name, version,
                                                                       self.config.name))
-        path = join(self.config.path, r[0])
-        # getting the file
+        return partial(self._open_image, name, version, r[0], r[1], self.layout)
+
+    def _open_image(self, name, version, md5, size, layout):
+        '''
+        Load an image from its md5 and size
+        '''
         arrow(u"Loading image %s v%s from repository %s" % (name,
                                                             version,
                                                             self.config.name))
-        memfile = StringIO()
+        # only metadata are read here, the image is checked when fully loaded
         try:
-            fo = PipeFile(path, "r")
-            fo.consume(memfile)
-            fo.close()
+            return PackageImage(self.objpath(md5, layout), md5name=True,
+                                md5=md5, size=size,
+                                objpath=partial(self.objpath, layout=layout))
         except Exception as e:
             raise ISError(u"Loading image %s v%s failed" % (name, version), e)
-        memfile.seek(0)
-        pkg = PackageImage(path, fileobj=memfile, md5name=True)
-        if pkg.md5 != r[0]:
-            raise ISError(u"Image MD5 verification failure")
-        return pkg
 
     def getmd5(self, name, version):
         '''
@@ -516,6 +953,7 @@ class Repository(object):
         # check local repository
         if not self.local:
             raise ISError(u"Repository must be local")
-        arrow("Updating motd")
-        self.db.ask("UPDATE repository SET motd = ?", (value,))
-        self.update_last()
+        with self.lock():
+            arrow("Updating motd")
+            self.db.ask("UPDATE repository SET motd = ?", (value,))
+            self.update_last()
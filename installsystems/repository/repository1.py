@@ -32,14 +32,11 @@ from tempfile import mkdtemp
 
 class Repository1(Repository):
 
-    def _add(self, image):
+    def _insert(self, image):
         '''
-        Add description to db
+        Insert image and payloads description into db
         '''
-        arrow("Adding metadata")
-        self.db.begin()
         # insert image information
-        arrow("Image", 1)
         self.db.ask("INSERT INTO image values (?,?,?,?,?,?,?)",
                     (image.md5,
                      image.name,
@@ -50,7 +47,6 @@ class Repository1(Repository):
                      image.size,
                      ))
         # insert data information
-        arrow("Payloads", 1)
         for name, obj in image.payload.items():
             self.db.ask("INSERT INTO payload values (?,?,?,?,?)",
                         (obj.md5,
@@ -59,10 +55,6 @@ class Repository1(Repository):
                          obj.isdir,
                          obj.size,
                          ))
-        # on commit
-        self.db.commit()
-        # update last file
-        self.update_last()
 
     def images(self):
         '''
@@ -20,16 +20,12 @@
 Repository v2
 '''
 
-from cStringIO import StringIO
 from installsystems.exception import ISError
-from installsystems.image.package import PackageImage
-from installsystems.printer import arrow, arrowlevel, warn, info, out, confirm
+from installsystems.printer import arrow, info, out
 from installsystems.repository.database import Database
 from installsystems.repository.repository1 import Repository1
-from installsystems.tools import PipeFile, isfile, chrights, mkdir, compare_versions
-from os import unlink, listdir, linesep, rmdir, symlink
-from os.path import join, exists, basename, isdir
-from shutil import move, rmtree
+from installsystems.tools import compare_versions
+from os.path import join, exists, isdir
 
 class Repository2(Repository1):
     '''
@@ -50,39 +46,6 @@ class Repository2(Repository1):
         '''
         return self.db.ask("SELECT uuid from repository").fetchone()[0]
 
-    def init(self):
-        '''
-        Initialize an empty base repository
-        '''
-        config = self.config
-        # check local repository
-        if not self.local:
-            raise ISError(u"Repository creation must be local")
-        # create base directories
-        arrow("Creating base directories")
-        arrowlevel(1)
-        # creating local directory
-        try:
-            if exists(config.path):
-                arrow(u"%s already exists" % config.path)
-            else:
-                mkdir(config.path, config.uid, config.gid, config.dmod)
-                arrow(u"%s directory created" % config.path)
-        except Exception as e:
-            raise ISError(u"Unable to create directory %s" % config.path, e)
-        arrowlevel(-1)
-        # create database
-        d = Database.create(config.dbpath)
-        chrights(config.dbpath, uid=config.uid,
-                         gid=config.gid, mode=config.fmod)
-        # load database
-        self.db = Database(config.dbpath)
-        # mark repo as not offline
-        self.config.offline = False
-        # create/update last file
-        self.update_last()
-
-
     def last(self, name):
         '''
         Return last version of name in repo or None if not found
@@ -95,14 +58,11 @@ class Repository2(Repository1):
         # return last
         return reduce(f, r)
 
-    def _add(self, image):
+    def _insert(self, image):
         '''
-        Add description to db
+        Insert image and payloads description into db
         '''
-        arrow("Adding metadata")
-        self.db.begin()
         # insert image information
-        arrow("Image", 1)
         self.db.ask("INSERT INTO image values (?,?,?,?,?,?,?,?,?)",
                     (image.md5,
                      image.name,
@@ -115,7 +75,6 @@ class Repository2(Repository1):
                      image.format,
                      ))
         # insert data information
-        arrow("Payloads", 1)
         for name, obj in image.payload.items():
             self.db.ask("INSERT INTO payload values (?,?,?,?,?)",
                         (obj.md5,
@@ -124,52 +83,6 @@ class Repository2(Repository1):
                          obj.isdir,
                          obj.size,
                          ))
-        # on commit
-        self.db.commit()
-        # update last file
-        self.update_last()
-
-    def add(self, image, delete=False):
-        '''
-        Add a packaged image to repository
-        if delete is true, remove original files
-        '''
-        # check local repository
-        if not self.local:
-            raise ISError(u"Repository addition must be local")
-        # cannot add already existant image
-        if self.has(image.name, image.version):
-            raise ISError(u"Image already in database, delete first!")
-        # adding file to repository
-        arrow("Copying images and payload")
-        for obj in [ image ] + image.payload.values():
-            dest = join(self.config.path, obj.md5)
-            basesrc = basename(obj.path)
-            if exists(dest):
-                arrow(u"Skipping %s: already exists" % basesrc, 1)
-            else:
-                arrow(u"Adding %s (%s)" % (basesrc, obj.md5), 1)
-                dfo = open(dest, "wb")
-                sfo = PipeFile(obj.path, "r", progressbar=True)
-                sfo.consume(dfo)
-                sfo.close()
-                dfo.close()
-                chrights(dest, self.config.uid,
-                                 self.config.gid, self.config.fmod)
-        # copy is done. create a image inside repo
-        r_image = PackageImage(join(self.config.path, image.md5),
-                               md5name=True)
-        # checking must be done with original md5
-        r_image.md5 = image.md5
-        # checking image and payload after copy
-        r_image.check("Check image and payload")
-        self._add(image)
-        # removing orginal files
-        if delete:
-            arrow("Removing original files")
-            for obj in [ image ] + image.payload.values():
-                arrow(basename(obj.path), 1)
-                unlink(obj.path)
 
     def getallmd5(self):
         '''
@@ -178,101 +91,6 @@ class Repository2(Repository1):
         res = self.db.ask("SELECT md5 FROM image UNION SELECT md5 FROM payload").fetchall()
         return [ md5[0] for md5 in res ]
 
-    def check(self):
-        '''
-        Check repository for unreferenced and missing files
-        '''
-        # Check if the repo is local
-        if not self.local:
-            raise ISError(u"Repository must be local")
-        local_files = set(listdir(self.config.path))
-        local_files.remove(self.config.dbname)
-        local_files.remove(self.config.lastname)
-        db_files = set(self.getallmd5())
-        # check missing files
-        arrow("Checking missing files")
-        missing_files = db_files - local_files
-        if len(missing_files) > 0:
-            out(linesep.join(missing_files))
-        # check unreferenced files
-        arrow("Checking unreferenced files")
-        unref_files = local_files - db_files
-        if len(unref_files) > 0:
-            out(linesep.join(unref_files))
-        # check corruption of local files
-        arrow("Checking corrupted files")
-        for f in local_files:
-            fo = PipeFile(join(self.config.path, f))
-            fo.consume()
-            fo.close()
-            if fo.md5 != f:
-                out(f)
-
-    def clean(self, force=False):
-        '''
-        Clean the repository's content
-        '''
-        # Check if the repo is local
-        if not self.local:
-            raise ISError(u"Repository must be local")
-        allmd5 = set(self.getallmd5())
-        repofiles = set(listdir(self.config.path)) - set([self.config.dbname, self.config.lastname])
-        dirtyfiles = repofiles - allmd5
-        if len(dirtyfiles) > 0:
-            # print dirty files
-            arrow("Dirty files:")
-            for f in dirtyfiles:
-                arrow(f, 1)
-            # ask confirmation
-            if not force and not confirm("Remove dirty files? (yes) "):
-                raise ISError(u"Aborted!")
-            # start cleaning
-            arrow("Cleaning")
-            for f in dirtyfiles:
-                p = join(self.config.path, f)
-                arrow(u"Removing %s" % p, 1)
-                try:
-                    if isdir(p):
-                        rmdir(p)
-                    else:
-                        unlink(p)
-                except:
-                    warn(u"Removing %s failed" % p)
-        else:
-            arrow("Nothing to clean")
-
-    def delete(self, name, version, payloads=True):
-        '''
-        Delete an image from repository
-        '''
-        # check local repository
-        if not self.local:
-            raise ISError(u"Repository deletion must be local")
-        # get md5 of files related to images (exception is raised if not exists
-        md5s = self.getmd5(name, version)
-        # cleaning db (must be done before cleaning)
-        arrow("Cleaning database")
-        arrow("Remove payloads from database", 1)
-        self.db.begin()
-        for md5 in md5s[1:]:
-            self.db.ask("DELETE FROM payload WHERE md5 = ? AND image_md5 = ?",
-                        (md5, md5s[0])).fetchone()
-        arrow("Remove image from database", 1)
-        self.db.ask("DELETE FROM image WHERE md5 = ?",
-                        (md5s[0],)).fetchone()
-        self.db.commit()
-        # Removing files
-        arrow("Removing files from pool")
-        # if asked don't remove payloads
-        if not payloads:
-            md5s = [ md5s[0] ]
-        arrowlevel(1)
-        for md5 in md5s:
-            self._remove_file(md5)
-        arrowlevel(-1)
-        # update last file
-        self.update_last()
-
     def images(self):
         '''
         Return a dict of information on images
@@ -284,10 +102,11 @@ class Repository2(Repository1):
         images = []
         field = ("md5", "name", "version", "date", "author", "description",
                  "size", "is_min_version", "format")
+        layout = self.layout
         for info in db_images:
             d = dict(zip(field, info))
             d["repo"] = self.config.name
-            d["url"] = join(self.config.path, d["md5"])
+            d["url"] = self.objpath(d["md5"], layout)
             images.append(d)
         return images
 
@@ -326,62 +145,12 @@ class Repository2(Repository1):
             out(u"   #yellow#Author:#reset# %s" % author)
             out(u"   #yellow#Description:#reset# %s" % description)
 
-    def _remove_file(self, filename):
-        '''
-        Remove a filename from pool. Check if it's not needed by db before
-        '''
-        # check existance in table image
-        have = False
-        for table in ("image", "payload"):
-            have = have or  self.db.ask(u"SELECT md5 FROM %s WHERE md5 = ? LIMIT 1" % table,
-                                        (filename,)).fetchone() is not None
-        # if no reference, delete!
-        if not have:
-            arrow(u"%s, deleted" % filename)
-            unlink(join(self.config.path, filename))
-        else:
-            arrow(u"%s, skipped" % filename)
-
     def has(self, name, version):
         '''
         Return the existance of a package
         '''
         return self.db.ask("SELECT name,version FROM image WHERE name = ? AND version = ? LIMIT 1", (name,version)).fetchone() is not None
 
-    def get(self, name, version=None):
-        '''
-        Return an image from a name and version
-        '''
-        # is no version take the last
-        if version is None:
-            version = self.last(name)
-            if version is None:
-                raise ISError(u"Unable to find image %s in %s" % (name,
-                                                                      self.config.name))
-        # get file md5 from db
-        r = self.db.ask("select md5 from image where name = ? and version = ? limit 1",
-                        (name, version)).fetchone()
-        if r is None:
-            raise ISError(u"Unable to find image %s v%s in %s" % (name, version,
-                                                                      self.config.name))
-        path = join(self.config.path, r[0])
-        # getting the file
-        arrow(u"Loading image %s v%s from repository %s" % (name,
-                                                            version,
-                                                            self.config.name))
-        memfile = StringIO()
-        try:
-            fo = PipeFile(path, "r")
-            fo.consume(memfile)
-            fo.close()
-        except Exception as e:
-            raise ISError(u"Loading image %s v%s failed" % (name, version), e)
-        memfile.seek(0)
-        pkg = PackageImage(path, fileobj=memfile, md5name=True)
-        if pkg.md5 != r[0]:
-            raise ISError(u"Image MD5 verification failure")
-        return pkg
-
     def getmd5(self, name, version):
         '''
         Return an image md5 and payload md5 from name and version. Order matter !
@@ -411,9 +180,18 @@ class Repository2(Repository1):
         # check local repository
         if not self.local:
             raise ISError(u"Repository must be local")
-        arrow("Updating motd")
-        self.db.ask("UPDATE repository SET motd = ?", (value,))
-        self.update_last()
+        with self.lock():
+            arrow("Updating motd")
+            self.db.ask("UPDATE repository SET motd = ?", (value,))
+            self.update_last()
 
     def upgrade(self):
-        info("No upgrade available")
+        '''
+        Upgrade repository database schema
+        '''
+        if self.db.version >= Database.version:
+            info(u"Repository already up-to-date (%s)" % self.db.version)
+            return
+        with self.lock():
+            self.db.upgrade()
+            self.update_last()
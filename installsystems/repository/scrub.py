@@ -0,0 +1,164 @@
+# -*- python -*-
+# -*- coding: utf-8 -*-
+
+# This file is part of Installsystems.
+#
+# Installsystems is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Installsystems is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Installsystems.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Repository scrubbing module
+'''
+
+from installsystems.exception import ISError
+from installsystems.printer import warn, debug
+from installsystems.tools import PipeFile, parallel_imap
+from itertools import izip
+from os import stat, access, W_OK
+from os.path import dirname, exists
+from time import time
+import sqlite3
+
+class Scrubber(object):
+    '''
+    Check md5 of pool files, in parallel and incrementally
+    The scrub database remembers size, mtime and date of the last successful
+    check of each file. Only new, modified or stale files are hashed again.
+    When the scrub database cannot be written (e.g. read-only mirrors), it is
+    kept in memory for the run.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        if (not access(dirname(path), W_OK) or
+            (exists(path) and not access(path, W_OK))):
+            debug(u"Scrub database %s is not writable, using memory" % path)
+            self.path = ":memory:"
+        try:
+            self.conn = sqlite3.connect(self.path, isolation_level=None)
+            self.conn.executescript(TEMPLATE_SCRUB_DB)
+        except Exception as e:
+            if self.path == ":memory:":
+                raise ISError(u"Unable to open scrub database", e)
+            warn(u"Unable to open scrub database %s, using memory: %s" % (path, e))
+            self.path = ":memory:"
+            self.conn = sqlite3.connect(self.path, isolation_level=None)
+            self.conn.executescript(TEMPLATE_SCRUB_DB)
+
+    def close(self):
+        '''
+        Close the scrub database
+        '''
+        self.conn.close()
+
+    def plan(self, files, max_age=None, io_budget=None):
+        '''
+        Return files which need to be hashed and the number of up to date files
+        files is a dict of path indexed by md5
+        Files never checked come first, then the oldest checked. If max_age
+        (in seconds) is None, all files are checked, otherwise unmodified files
+        checked less than max_age seconds ago are skipped.
+        io_budget limit the total size of files to hash.
+        '''
+        now = time()
+        known = {}
+        for md5, size, mtime, verified in self.conn.execute(
+            "SELECT md5, size, mtime, verified FROM verified"):
+            known[md5] = (size, mtime, verified)
+        todo = []
+        uptodate = 0
+        for md5, path in files.items():
+            try:
+                st = stat(path)
+            except OSError:
+                # file removed since listing
+                continue
+            size, mtime = st.st_size, int(st.st_mtime)
+            verified = 0
+            entry = known.get(md5)
+            if entry is not None and entry[:2] == (size, mtime):
+                verified = entry[2]
+                if max_age is not None and now - verified < max_age:
+                    uptodate += 1
+                    continue
+            todo.append((verified, md5, path, size, mtime))
+        todo.sort()
+        if io_budget is not None:
+            total = 0
+            for i, (verified, md5, path, size, mtime) in enumerate(todo):
+                total += size
+                # always check at least one file to progress
+                if total > io_budget and i > 0:
+                    todo = todo[:i]
+                    break
+        return [ x[1:] for x in todo ], uptodate
+
+    def scrub(self, todo, jobs=None, time_budget=None):
+        '''
+        Hash files returned by plan with a pool of jobs processes
+        Yield (md5, size, status) for each file, where status is ok, corrupted
+        or unreadable, until time_budget (in seconds) is exhausted
+        '''
+        start = time()
+        results = parallel_imap(_hash_file, [ x[1] for x in todo ], jobs,
+                                process=True)
+        try:
+            for (md5, path, size, mtime), digest in izip(todo, results):
+                if digest is None:
+                    status = "unreadable"
+                elif digest == md5:
+                    status = "ok"
+                else:
+                    status = "corrupted"
+                if status == "ok":
+                    self.conn.execute("INSERT OR REPLACE INTO verified values (?,?,?,?)",
+                                      (md5, size, mtime, int(time())))
+                else:
+                    self.conn.execute("DELETE FROM verified WHERE md5 = ?", (md5,))
+                yield md5, size, status
+                if time_budget is not None and time() - start > time_budget:
+                    break
+        finally:
+            # stop the pool
+            results.close()
+
+    def forget(self, md5s):
+        '''
+        Remove files which are not in the pool anymore
+        '''
+        known = set(r[0] for r in self.conn.execute("SELECT md5 FROM verified"))
+        self.conn.execute("BEGIN TRANSACTION")
+        for md5 in known - set(md5s):
+            self.conn.execute("DELETE FROM verified WHERE md5 = ?", (md5,))
+        self.conn.execute("COMMIT TRANSACTION")
+
+
+def _hash_file(path):
+    '''
+    Return md5 of file at path, or None if it cannot be read
+    This runs inside pool processes
+    '''
+    try:
+        fo = PipeFile(path, "r")
+        fo.consume()
+        fo.close()
+    except (IOError, OSError, ISError):
+        return None
+    return fo.md5
+
+TEMPLATE_SCRUB_DB = u"""
+CREATE TABLE IF NOT EXISTS verified (md5 TEXT NOT NULL PRIMARY KEY,
+                                     size INTEGER NOT NULL,
+                                     mtime INTEGER NOT NULL,
+                                     verified INTEGER NOT NULL);
+"""
@@ -24,11 +24,14 @@ from hashlib import md5
 from installsystems import VERSION, CANONICAL_NAME
 from installsystems.exception import ISError
 from installsystems.printer import VERBOSITY, warn, debug, arrow
+from installsystems.profiler import add_bytes
 from itertools import takewhile
 from jinja2 import Template
 from locale import getpreferredencoding
 from math import log
-from os import environ, pathsep, walk, rename, symlink, unlink
+from multiprocessing import cpu_count, Pool, TimeoutError
+from multiprocessing.pool import ThreadPool
+from os import environ, pathsep, walk, rename, symlink, unlink, listdir
 from os import stat, lstat, fstat, makedirs, chown, chmod, utime
 from os.path import exists, join, isdir, ismount, splitext
 from progressbar import Bar, BouncingBar, ETA, UnknownLength
@@ -36,12 +39,33 @@ from progressbar import FileTransferSpeed
 from progressbar import Widget, ProgressBar, Percentage
 from re import match, compile
 from shutil import copy
+from signal import signal, SIGINT, SIG_IGN
 from socket import getdefaulttimeout
 from stat import S_ISDIR, S_ISREG
-from subprocess import call, check_call, CalledProcessError
+from subprocess import call, check_call, check_output, CalledProcessError
 from time import mktime, gmtime, strftime, strptime
 from urllib2 import urlopen, Request
 
+# scandir is an optional speedup of directory walking
+try:
+    from scandir import scandir as _scandir
+except ImportError:
+    _scandir = None
+
+# number of threads of parallel (de)compressors, 0 is the number of cpu
+COMPRESSOR_THREADS = 0
+
+# (de)compressors argv chosen by get_compressor_path, by name and mode
+_compressors = {}
+
+# valid compression levels, by compressor
+COMPRESSION_LEVELS = {"gzip": (1, 9), "bzip2": (1, 9), "xz": (0, 9),
+                      "zstd": (1, 19), "lz4": (1, 12)}
+
+# magic strings of compressed data, by compressor
+COMPRESSOR_MAGICS = {"gzip": "\x1f\x8b", "bzip2": "BZh", "xz": "\xfd7zXZ\x00",
+                     "zstd": "\x28\xb5\x2f\xfd", "lz4": "\x04\x22\x4d\x18"}
+
 
 ################################################################################
 # Classes
@@ -79,16 +103,22 @@ class PipeFile(object):
 
 
     def __init__(self, path=None, mode="r", fileobj=None, timeout=None,
-                 progressbar=False):
-        self.open(path, mode, fileobj, timeout, progressbar)
+                 progressbar=False, head=None):
+        self.open(path, mode, fileobj, timeout, progressbar, head)
 
-    def open(self, path=None, mode="r", fileobj=None, timeout=None, progressbar=False):
+    def open(self, path=None, mode="r", fileobj=None, timeout=None, progressbar=False,
+             head=None):
+        '''
+        Open a PipeFile
+        head limits reading to the first head bytes (an http range request)
+        '''
         if path is None and fileobj is None:
             raise AttributeError("You must have a path or a fileobj to open")
         if mode not in ("r", "w"):
             raise AttributeError("Invalid open mode. Must be r or w")
         self.timeout = timeout or getdefaulttimeout()
         self.mode = mode
+        self.head = head
         self._md5 = md5()
         self.size = 0
         self.mtime = None
@@ -141,6 +171,8 @@ class PipeFile(object):
         '''
         try:
             headers = {"User-Agent": "%s v%s" % (CANONICAL_NAME, VERSION)}
+            if self.head is not None:
+                headers["Range"] = "bytes=0-%d" % (self.head - 1)
             request = Request(path, None, headers)
             self.fo = urlopen(request, timeout=self.timeout)
         except Exception as e:
@@ -218,10 +250,15 @@ class PipeFile(object):
     def read(self, size=None):
         if self.mode == "w":
             raise ISError("Unable to read in w mode")
+        # don't read after head, server may not honor range requests
+        if self.head is not None:
+            left = self.head - self.consumed_size
+            size = left if size is None or size < 0 else min(size, left)
         buf = self.fo.read(size)
         length = len(buf)
         self._md5.update(buf)
         self.consumed_size += length
+        add_bytes(length)
         if self.progressbar and length > 0:
             self._progressbar.update(self.consumed_size)
         return buf
@@ -237,6 +274,7 @@ class PipeFile(object):
         length = len(buf)
         self._md5.update(buf)
         self.consumed_size += length
+        add_bytes(length)
         if self.progressbar and length > 0:
             self._progressbar.update(self.consumed_size)
         return None
@@ -397,12 +435,25 @@ def getsize(path):
                     total_sz += filestat.st_size
     return total_sz
 
+def scandir(path):
+    '''
+    Yield (name, path, isdir) for each entry of directory path
+    scandir module is used when available, it avoids a stat by entry
+    '''
+    if _scandir is not None:
+        for entry in _scandir(path):
+            yield entry.name, entry.path, entry.is_dir()
+    else:
+        for name in listdir(path):
+            epath = join(path, name)
+            yield name, epath, isdir(epath)
+
 def human_size(num, unit='B'):
     '''
     Return human readable size
     '''
     prefixes = ('','Ki', 'Mi', 'Gi', 'Ti','Pi', 'Ei', 'Zi', 'Yi')
-    power = int(log(num, 1024))
+    power = int(log(num, 1024)) if num > 0 else 0
     # max is YiB
     if power >= len(prefixes):
         power = len(prefixes) - 1
@@ -662,37 +713,100 @@ def str_version_array(str_version, size):
             a[i] = char + 256
     return a
 
-def get_compressor_path(name, compress=True, level=None):
+def set_compressor_threads(threads):
     '''
-    Return better compressor argv from its generic compressor name
-    e.g: bzip2 can return pbzip2 if available or bzip2 if not
+    Set the number of threads of parallel (de)compressors
+    0 is the number of cpu
     '''
-    compressors = {"none": [["cat"]],
-                   "gzip": [["gzip", "--no-name", "--stdout"]],
-                   "bzip2": [["pbzip2", "--stdout"],
-                             ["bzip2", "--compress", "--stdout"]],
-                   "xz": [["xz", "--compress", "--stdout"]]}
-    decompressors = {"none": [["cat"]],
-                     "gzip": [["gzip", "--decompress", "--stdout"]],
-                     "bzip2": [["pbzip2","--decompress", "--stdout"],
-                               ["bzip2", "--decompress", "--stdout"]],
-                     "xz": [["xz", "--decompress", "--stdout"]]}
-    # no compress level for decompression
-    if not compress:
-        level = None
+    global COMPRESSOR_THREADS
+    if threads < 0:
+        raise ISError(u"Invalid number of compressor threads: %s" % threads)
+    COMPRESSOR_THREADS = threads
+
+def _xz_version():
+    '''
+    Return xz version as a tuple of integers, (0,) if unknown
+    '''
+    try:
+        version = check_output(["xz", "--version"]).split()[3]
+        return tuple(int(x) for x in version.split("."))
+    except Exception:
+        return (0,)
+
+def _find_compressor(name, compress):
+    '''
+    Return the argv of the best available (de)compressor from its generic name
+    Argv may contain a {threads} field
+    '''
+    # (argv, required version) by order of preference
+    compressors = {"none": [(["cat"], None)],
+                   "gzip": [(["pigz", "--no-name", "--stdout",
+                              "--processes", "{threads}"], None),
+                            (["gzip", "--no-name", "--stdout"], None)],
+                   "bzip2": [(["pbzip2", "--stdout", "-p{threads}"], None),
+                             (["bzip2", "--compress", "--stdout"], None)],
+                   "xz": [(["xz", "--compress", "--stdout",
+                            "--threads={threads}"], (5, 2)),
+                          (["pixz", "-p", "{threads}"], None),
+                          (["xz", "--compress", "--stdout"], None)],
+                   "zstd": [(["zstd", "--compress", "--stdout", "--quiet",
+                              "-T{threads}"], None)],
+                   "lz4": [(["lz4", "--compress", "--stdout", "--quiet"], None)]}
+    decompressors = {"none": [(["cat"], None)],
+                     "gzip": [(["pigz", "--decompress", "--stdout"], None),
+                              (["gzip", "--decompress", "--stdout"], None)],
+                     "bzip2": [(["pbzip2", "--decompress", "--stdout",
+                                 "-p{threads}"], None),
+                               (["bzip2", "--decompress", "--stdout"], None)],
+                     "xz": [(["xz", "--decompress", "--stdout",
+                              "--threads={threads}"], (5, 4)),
+                            (["pixz", "-d", "-p", "{threads}"], None),
+                            (["xz", "--decompress", "--stdout"], None)],
+                     "zstd": [(["zstd", "--decompress", "--stdout", "--quiet"],
+                               None)],
+                     "lz4": [(["lz4", "--decompress", "--stdout", "--quiet"],
+                              None)]}
     allcompressors = compressors if compress else decompressors
     # check compressor exists
     if name not in allcompressors.keys():
         raise ISError(u"Invalid compressor name: %s" % name)
     # get valid compressors
-    for compressor in allcompressors[name]:
-        path = pathsearch(compressor[0])
-        if path is None:
+    for compressor, version in allcompressors[name]:
+        if pathsearch(compressor[0]) is None:
+            continue
+        # only xz threading depends of its version
+        if version is not None and _xz_version() < version:
             continue
-        if level is not None:
-            compressor.append("-%d" % level)
         return compressor
-    raise ISError(u"No external decompressor for %s" % name)
+    return None
+
+def get_compressor_path(name, compress=True, level=None, threads=None):
+    '''
+    Return better compressor argv from its generic compressor name
+    e.g: bzip2 can return pbzip2 if available or bzip2 if not
+    Parallel implementations are preferred and run threads threads
+    (default: COMPRESSOR_THREADS). Available compressors are searched once
+    by name.
+    '''
+    if (name, compress) not in _compressors:
+        _compressors[(name, compress)] = _find_compressor(name, compress)
+    compressor = _compressors[(name, compress)]
+    if compressor is None:
+        raise ISError(u"No external decompressor for %s" % name)
+    if threads is None:
+        threads = COMPRESSOR_THREADS
+    threads = str(threads or cpu_count())
+    argv = [arg.replace("{threads}", threads) for arg in compressor]
+    # no compress level for decompression
+    if compress and level is not None and name != "none":
+        low, high = COMPRESSION_LEVELS[name]
+        if not low <= level <= high:
+            raise ISError(u"Invalid %s compression level %s (%d-%d)" %
+                          (name, level, low, high))
+        argv.append("-%d" % level)
+    debug(u"Using %s %s" % ("compressor" if compress else "decompressor",
+                            " ".join(argv)))
+    return argv
 
 def render_templates(target, context, tpl_ext=".istpl", force=False, keep=False):
     '''
@@ -738,3 +852,43 @@ def strcspn(string, pred):
     Python implementation of libc strcspn
     '''
     return len(list(takewhile(lambda x: x not in pred, string)))
+
+def _pool_init():
+    '''
+    Initialize a pool process, only the main process handle keyboard interrupt
+    '''
+    signal(SIGINT, SIG_IGN)
+
+def parallel_imap(func, iterable, jobs=None, process=False):
+    '''
+    Yield func(item) for each item of iterable, in order, computed by a pool
+    of jobs threads (default: number of cpu)
+    Threads are fine for our I/O bound jobs, hashing and file I/O release the GIL
+    if process is true, a pool of processes is used for cpu bound jobs. func
+    must be a module function in that case
+    '''
+    items = list(iterable)
+    if jobs is None:
+        jobs = cpu_count()
+    # no need of a pool for one job
+    if jobs <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+    if process:
+        pool = Pool(min(jobs, len(items)), _pool_init)
+    else:
+        pool = ThreadPool(min(jobs, len(items)))
+    try:
+        results = pool.imap(func, items)
+        for _ in items:
+            while True:
+                try:
+                    # waiting with a timeout let KeyboardInterrupt be raised
+                    result = results.next(1)
+                    break
+                except TimeoutError:
+                    pass
+            yield result
+    finally:
+        pool.terminate()